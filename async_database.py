@@ -0,0 +1,99 @@
+import asyncio
+import queue
+import threading
+from typing import Any, Callable, List, Sequence, Tuple
+
+from database import close_db_connection
+
+class AsyncDatabase:
+    # Функции database.py выполняются в отдельном потоке со своим соединением (соединения в database.py
+    # привязаны к потоку), поэтому ожидание блокировки SQLite не останавливает цикл событий бота.
+    # Поток забирает из очереди все накопившиеся запросы сразу и возвращает их результаты
+    # в цикл событий одним вызовом на пачку
+    def __init__(self, max_batch: int = 64):
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'max_batch': 0}
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, name='database', daemon=True)
+                self.thread.start()
+
+    def _next_batch(self) -> list:
+        batch = [self.requests.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                stop = False
+                results = {}
+                for request in batch:
+                    if request is None:
+                        stop = True
+                        continue
+                    loop, future, calls = request
+                    try:
+                        outcome = ([func(*args, **kwargs) for func, args, kwargs in calls], None)
+                    except Exception as e:
+                        outcome = (None, e)
+                    results.setdefault(loop, []).append((future, outcome))
+
+                for loop, items in results.items():
+                    try:
+                        loop.call_soon_threadsafe(self._resolve, items)
+                    except RuntimeError:
+                        # Цикл событий уже закрыт, результаты никто не ждет
+                        pass
+                self.stats['batches'] += 1
+                self.stats['requests'] += len(batch) - stop
+                self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+                if stop:
+                    return
+        finally:
+            close_db_connection()
+
+    @staticmethod
+    def _resolve(items):
+        for future, (result, error) in items:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _submit(self, calls: List[Tuple[Callable, tuple, dict]]) -> list:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._ensure_started()
+        self.requests.put((loop, future, calls))
+        return await future
+
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        results = await self._submit([(func, args, kwargs)])
+        return results[0]
+
+    async def call_many(self, calls: Sequence[tuple]) -> list:
+        # Несколько вызовов вида (функция, *аргументы) выполняются подряд за одно обращение к потоку
+        return await self._submit([(call[0], tuple(call[1:]), {}) for call in calls])
+
+    def close(self, timeout: float = 30):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None and thread.is_alive():
+            self.requests.put(None)
+            thread.join(timeout)
+
+db = AsyncDatabase()
@@ -0,0 +1,118 @@
+import itertools
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database
+
+MESSAGES = 1000000
+USERS = 100000
+SOURCES = ['telegram', 'vk', 'hh']
+# Общий счетчик для замеров «до» и «после»: иначе второй замер вставлял бы уже существующие сообщения
+bench_numbers = itertools.count()
+
+def fill(path, rng):
+    conn = sqlite3.connect(path)
+    database.migrate(conn, target=1)
+    # cleanup_old_messages чистит и очередь рассылки: ее таблицы (пустые) нужны уже в базе «до»,
+    # индексы и настройки миграций 2 и 3 по-прежнему добавляются только перед замером «после»
+    for statement in dict(database.MIGRATIONS)[3]:
+        if statement.strip().startswith('CREATE TABLE'):
+            conn.execute(statement)
+    now = datetime.now()
+
+    users = []
+    for user_id in range(1, USERS + 1):
+        subscribed = rng.random() < 0.2
+        end_date = (now + timedelta(days=rng.randint(-30, 90))).strftime('%Y-%m-%d %H:%M:%S') if subscribed else None
+        users.append((user_id, f"user{user_id}", int(subscribed), end_date, 1, int(rng.random() < 0.8),
+                      1, 1, 1, now.strftime('%Y-%m-%d %H:%M:%S'), 'user'))
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', users)
+
+    batch = []
+    for number in range(MESSAGES):
+        source = rng.choice(SOURCES)
+        sent_date = (now - timedelta(seconds=rng.randint(0, 60 * 24 * 3600))).strftime('%Y-%m-%d %H:%M:%S')
+        batch.append((f"{source}_{number % 500}_{number}", str(number % 500), source, "текст заказа " * 10,
+                      None, sent_date, sent_date))
+        if len(batch) == 50000:
+            conn.executemany('INSERT INTO sent_messages VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT INTO sent_messages VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+    conn.close()
+
+def use_connection(conn):
+    database.close_db_connection()
+    database.thread_local.connection = conn
+
+def measure(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+def run_queries(rng):
+    lookups = [f"{rng.choice(SOURCES)}_{n % 500}_{n}" for n in (rng.randrange(MESSAGES * 2) for _ in range(2000))]
+    conn = database.get_db_connection()
+
+    def add_message():
+        number = next(bench_numbers)
+        message = {'source': 'vk', 'owner_id': -1, 'message_id': f"bench{number}", 'text': 'текст'}
+        database.enqueue_outbox([{'message': message, 'text': 'текст', 'media_path': None, 'recipients': []}])
+
+    def load_recipients():
+        # Кэш аудитории сбрасывается перед каждым вызовом: замеряется запрос к users, а не попадание в кэш
+        database.audience_cache.invalidate()
+        database.get_recipients('telegram')
+
+    def pk_lookups():
+        for message_id in lookups:
+            conn.execute('SELECT 1 FROM sent_messages WHERE message_id = ?', (message_id,)).fetchone()
+
+    return {
+        'get_sent_messages_stats()': measure(database.get_sent_messages_stats, 3),
+        'cleanup_old_messages(365)': measure(lambda: database.cleanup_old_messages(365), 3),
+        'get_recipients() без кэша': measure(load_recipients, 3),
+        'sent_messages WHERE source = ?': measure(lambda: conn.execute(
+            'SELECT COUNT(*) FROM sent_messages WHERE source = ?', ('hh',)).fetchone(), 3),
+        '2000 поисков по message_id': measure(pk_lookups, 3),
+        'enqueue_outbox() x1': measure(add_message, 200)
+    }
+
+def main():
+    rng = random.Random(42)
+    folder = tempfile.mkdtemp(prefix='bench_database_')
+    path = os.path.join(folder, 'users.db')
+    try:
+        print(f"Заполняем базу: {MESSAGES} отправленных сообщений, {USERS} пользователей...")
+        started = time.perf_counter()
+        fill(path, rng)
+        print(f"Готово за {time.perf_counter() - started:.1f} с")
+
+        database.DB_PATH = path
+        database.sent_index = database.SentMessagesIndex(os.path.join(folder, 'sent_index.bin'))
+
+        # До миграции 2: журнал по умолчанию, без индексов и без настроек соединения
+        use_connection(sqlite3.connect(path, timeout=20))
+        before = run_queries(random.Random(1))
+
+        use_connection(database.configure_connection(sqlite3.connect(path, timeout=20)))
+        started = time.perf_counter()
+        version = database.migrate(database.get_db_connection())
+        print(f"Миграция до версии {version} за {time.perf_counter() - started:.1f} с")
+        after = run_queries(random.Random(1))
+
+        print(f"\n{'запрос':<32} {'до, мс':>10} {'после, мс':>10} {'ускорение':>10}")
+        for name in before:
+            print(f"{name:<32} {before[name]:10.2f} {after[name]:10.2f} {before[name] / after[name]:9.1f}x")
+    finally:
+        database.close_db_connection()
+        shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import random
+import time
+
+from keyword_filter import get_filter
+
+INCLUDE_FILTERS = [
+    "видео", "видеомонтаж", "рилс", "монтаж", "монтажёр", "монтажер", "монтаж видео",
+    "сторис", "сторисы", "рилсы", "reels", "youtube", "shorts", "клип", "ролик"
+]
+EXCLUDE_FILTERS = ["резюме", "ищу", "помогу", "создаю", "сделаю"]
+
+FILLER = (
+    "требуется специалист в команду маркетинга работа с текстами дизайн баннеров ведение соцсетей "
+    "оплата сдельная удаленно опыт от года портфолио обязательно задачи проекта сроки бюджет обсуждаем "
+    "компания офис график обучение условия дружный коллектив навыки знание программ adobe figma excel"
+).split()
+
+def legacy_should_save(text, include_filters, exclude_filters):
+    # Прежняя реализация should_save_message без вывода в консоль
+    text = text.lower()
+    for word in exclude_filters:
+        if word.lower() in text:
+            return False
+    if include_filters:
+        for word in include_filters:
+            if word.lower() in text:
+                return True
+        return False
+    return True
+
+def make_texts(count, words_per_text, rng):
+    # Большинство текстов не содержит ни одного слова из фильтров, как и в реальных каналах
+    texts = []
+    for _ in range(count):
+        words = [rng.choice(FILLER) for _ in range(words_per_text)]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(INCLUDE_FILTERS))
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(EXCLUDE_FILTERS))
+        texts.append(" ".join(words))
+    return texts
+
+def make_channels(count, rng):
+    return [
+        (rng.sample(INCLUDE_FILTERS, 12), rng.sample(EXCLUDE_FILTERS, 3))
+        for _ in range(count)
+    ]
+
+def bench(name, func, texts, channels):
+    started = time.perf_counter()
+    accepted = 0
+    for text in texts:
+        for include_filters, exclude_filters in channels:
+            accepted += func(text, include_filters, exclude_filters)
+    elapsed = time.perf_counter() - started
+    checks = len(texts) * len(channels)
+    print(f"{name:<10} {elapsed * 1000:9.1f} мс  {elapsed / checks * 1e6:7.2f} мкс/проверка  принято {accepted}")
+    return elapsed
+
+def compiled_should_save(text, include_filters, exclude_filters):
+    return get_filter(include_filters, exclude_filters).match(text).accepted
+
+def main():
+    rng = random.Random(42)
+    channels = make_channels(50, rng)
+
+    for title, words_per_text in [("Посты Telegram/VK (~40 слов)", 40), ("Вакансии HH (~400 слов)", 400)]:
+        texts = make_texts(400, words_per_text, rng)
+
+        for text in texts:
+            for include_filters, exclude_filters in channels:
+                assert legacy_should_save(text, include_filters, exclude_filters) == \
+                    compiled_should_save(text, include_filters, exclude_filters)
+
+        print(f"\n{title}: {len(texts)} текстов × {len(channels)} каналов")
+        legacy = bench("legacy", legacy_should_save, texts, channels)
+        compiled = bench("compiled", compiled_should_save, texts, channels)
+        print(f"ускорение: {legacy / compiled:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import json
 import asyncio
 import os
+import importlib
 import random
 import signal
 import subprocess
@@ -8,7 +9,7 @@ import psutil
 import re
 from telethon import TelegramClient, events, Button
 from telethon.errors import MessageNotModifiedError
-from datetime import datetime, timedelta
+from datetime import datetime
 import glob
 from database import (
     add_user, 
@@ -20,24 +21,23 @@ from database import (
     update_sources,
     set_all_sources,
     set_admin,
-    get_all_subscribed_users,
-    add_sent_message,
+    get_recipients,
+    enqueue_outbox,
+    get_outbox_stats,
     get_sent_messages_stats,
-    cleanup_old_messages,
     is_message_sent,
-    reset_subscription
+    reset_subscription,
+    audience_cache,
+    sent_index
 )
-import sqlite3
+from config_store import get_config, get_config_path, save_config as store_config
+from async_database import db
+from delivery import media_uploads, outbox
+import media_store
 
 # Загружаем конфигурацию с учетом отсутствия основного файла
-config_file = 'config.json'
-if not os.path.exists(config_file):
-    config_file = 'config.example.json'
-    print(f"⚠️ Файл config.json не найден, используем {config_file}")
-    print("⚠️ Создайте файл config.json на основе примера и заполните его вашими данными")
-
-with open(config_file, 'r', encoding='utf-8') as f:
-    config = json.load(f)
+config_file = get_config_path()
+config = get_config()
 
 for source in config['sources'].values():
     if source.get('enabled', False):
@@ -74,8 +74,7 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 async def save_config():
-    with open('config.json', 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    store_config(config)
 
 def kill_process_tree(pid):
     try:
@@ -111,43 +110,29 @@ async def send_order_to_users(message):
             print(f"Пропускаем сообщение из недавно добавленного источника {source_id}")
             return
             
-        if is_message_sent(message['source'], source_id, str(message['message_id'])):
+        if await db.call(is_message_sent, message['source'], source_id, str(message['message_id'])):
             print(f"Сообщение {message['message_id']} из {message['source']} {source_id} уже было отправлено")
             return
             
-        users = get_all_subscribed_users()
-        
-        sent_to_users = False
-        
-        for user in users:
-            if not user['orders_enabled']:
-                continue
-                
-            if message['source'] == 'telegram' and not user['tg']:
-                continue
-            elif message['source'] == 'vk' and not user['vk']:
-                continue
-            elif message['source'] == 'site' and not user['site']:
-                continue
-            
-            source_emoji = "📢" if message['source'] == 'telegram' else "📱"
-            formatted_message = f"""
+        source_emoji = "📢" if message['source'] == 'telegram' else "📱"
+        formatted_message = f"""
 {source_emoji} Новый заказ из {message['source'].title()}
 
 📝 Текст:
 {message['text']}
 """
-            try:
-                if message.get('media_path') and os.path.exists(message['media_path']):
-                    await bot.send_message(user['user_id'], formatted_message, file=message['media_path'])
-                else:
-                    await bot.send_message(user['user_id'], formatted_message)
-                sent_to_users = True
-            except Exception as e:
-                print(f"Ошибка при отправке сообщения пользователю {user['user_id']}: {str(e)}")
-                
-        if sent_to_users:
-            add_sent_message(message)
+        media_path = message.get('media_path') if message.get('media_path') and os.path.exists(message['media_path']) else None
+        recipients = await db.call(get_recipients, message['source'])
+        if not recipients:
+            return
+        
+        await db.call(enqueue_outbox, [{
+            'message': message,
+            'text': formatted_message,
+            'media_path': media_path,
+            'recipients': recipients
+        }])
+        await outbox.dispatch(bot)
                 
     except Exception as e:
         print(f"Ошибка при рассылке заказа: {str(e)}")
@@ -184,11 +169,78 @@ def clean_html(html_text: str) -> str:
     
     return clean_text.strip()
 
+async def deliver_message(source, message, recipients=None, outbox_batch=None):
+    if source == 'telegram':
+        source_id = str(message['channel_id'])
+        message_id = str(message['message_id'])
+    elif source == 'vk':
+        source_id = str(message['owner_id'])
+        message_id = str(message['message_id'])
+    elif source == 'hh':
+        source_id = 'hh'
+        message_id = str(message['vacancy_id'])
+        print(f"\n💼 Обработка вакансии HH {message_id}:")
+        print(f"📝 Заголовок: {message.get('title', 'Нет заголовка')}")
+    else:
+        return
+    
+    if await db.call(is_message_sent, source, source_id, message_id):
+        print(f"✓ Сообщение {message_id} из {source} {source_id} уже было отправлено")
+        await db.call(media_store.release_parsed, [message])
+        return
+    else:
+        print(f"🆕 Найдено новое сообщение {message_id} из {source} {source_id}")
+    
+    if source == 'telegram':
+        text = f"📱 Новый заказ из Telegram\n\n{message['text']}"
+    elif source == 'vk':
+        text = f"💻 Новый заказ из VK\n\n{message['text']}"
+    elif source == 'hh':
+        description = clean_html(message.get('description', ''))
+        text = (f"💼 Новая вакансия с HH.ru\n\n"
+               f"🔹 {message['title']}\n"
+               f"💰 {message['salary']}\n"
+               f"🏢 {message['company']}\n\n"
+               f"📝 {description}\n\n"
+               f"🔗 {message['link']}")
+    else:
+        return
+    
+    # Список получателей уже учитывает подписку, включенные уведомления и выбранные источники
+    if recipients is None:
+        recipients = await db.call(get_recipients, source)
+    
+    if not recipients:
+        print(f"ℹ️ Сообщение {message_id} некому отправлять")
+        await db.call(media_store.release_parsed, [message])
+        return
+    
+    media_path = message.get('media_path') if message.get('media_path') and os.path.exists(message['media_path']) else None
+    # Рассылка идет через таблицу outbox: задание на каждого получателя, отправка и повторы в delivery.py
+    item = {
+        'message': message,
+        'text': text,
+        'media_path': media_path,
+        'recipients': recipients
+    }
+    
+    if outbox_batch is not None:
+        # В очередь сообщения поставит process_new_messages одной транзакцией в конце прохода
+        outbox_batch.append(item)
+        return
+    
+    queued = await db.call(enqueue_outbox, [item])
+    await db.call(media_store.release_parsed, [message])
+    print(f"📥 Сообщение {message_id} из {source} {source_id} поставлено в очередь для {queued} получателей")
+    await outbox.dispatch(bot)
+    if media_path:
+        print(f"📎 {media_uploads.report()}")
+
 async def process_new_messages(source):
     try:
-        users = get_all_subscribed_users()
-        if not users:
-            print("Нет пользователей с активной подпиской")
+        recipients = await db.call(get_recipients, source)
+        if not recipients:
+            print(f"Нет пользователей с активной подпиской на источник {source}")
             return
 
         messages_folder = config['sources'][source]['messages_folder']
@@ -203,97 +255,34 @@ async def process_new_messages(source):
         latest_file = message_files[0]
         print(f"📄 Обрабатываем файл: {latest_file}")
         
+        outbox_batch = []
         try:
             with open(latest_file, 'r', encoding='utf-8') as f:
                 messages = json.load(f)
                 print(f"📨 Найдено {len(messages)} сообщений в файле")
                 
             for message in messages:
-                if source == 'telegram':
-                    source_id = str(message['channel_id'])
-                    message_id = str(message['message_id'])
-                elif source == 'vk':
-                    source_id = str(message['owner_id'])
-                    message_id = str(message['message_id'])
-                elif source == 'hh':
-                    source_id = 'hh'
-                    message_id = str(message['vacancy_id'])
-                    print(f"\n💼 Обработка вакансии HH {message_id}:")
-                    print(f"📝 Заголовок: {message.get('title', 'Нет заголовка')}")
-                else:
-                    continue
-                
-                if is_message_sent(source, source_id, message_id):
-                    print(f"✓ Сообщение {message_id} из {source} {source_id} уже было отправлено")
-                    continue
-                else:
-                    print(f"🆕 Найдено новое сообщение {message_id} из {source} {source_id}")
-                
-                if source == 'telegram':
-                    text = f"📱 Новый заказ из Telegram\n\n{message['text']}"
-                elif source == 'vk':
-                    text = f"💻 Новый заказ из VK\n\n{message['text']}"
-                elif source == 'hh':
-                    description = clean_html(message.get('description', ''))
-                    text = (f"💼 Новая вакансия с HH.ru\n\n"
-                           f"🔹 {message['title']}\n"
-                           f"💰 {message['salary']}\n"
-                           f"🏢 {message['company']}\n\n"
-                           f"📝 {description}\n\n"
-                           f"🔗 {message['link']}")
-                else:
-                    continue
-                
-                sent_to_users = False
-                
-                for user in users:
-                    try:
-                        if source == 'telegram' and not user['tg']:
-                            continue
-                        elif source == 'vk' and not user['vk']:
-                            continue
-                        elif source == 'hh' and not user['site']:
-                            print(f"👤 Пользователь {user['user_id']} не подписан на сайты, пропускаем")
-                            continue
-                            
-                        if not user['orders_enabled']:
-                            print(f"👤 У пользователя {user['user_id']} отключены уведомления, пропускаем")
-                            continue
-                            
-                        if message.get('media_path') and os.path.exists(message['media_path']):
-                            await bot.send_file(user['user_id'], 
-                                              message['media_path'],
-                                              caption=text[:1024])
-                        else:
-                            await bot.send_message(user['user_id'], text)
-                            
-                        sent_to_users = True
-                        print(f"✅ Сообщение {message_id} отправлено пользователю {user['user_id']}")
-                        await asyncio.sleep(0.5)
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка при отправке сообщения пользователю {user['user_id']}: {str(e)}")
-                        continue
-                
-                if sent_to_users:
-                    try:
-                        add_sent_message(message)
-                        print(f"✅ Сообщение {message_id} из {source} {source_id} успешно отправлено и сохранено в базе")
-                    except Exception as e:
-                        print(f"❌ Ошибка при сохранении информации об отправленном сообщении: {str(e)}")
-                else:
-                    print(f"ℹ️ Сообщение {message_id} не было отправлено ни одному пользователю")
+                await deliver_message(source, message, recipients, outbox_batch)
                 
         except Exception as e:
             print(f"❌ Ошибка при обработке файла {latest_file}: {str(e)}")
-            return
+        finally:
+            # Новые сообщения ставятся в очередь одной транзакцией, затем очередь рассылается
+            # вместе с заданиями, оставшимися от прошлых проходов
+            if outbox_batch:
+                queued = await db.call(enqueue_outbox, outbox_batch)
+                await db.call(media_store.release_parsed, [item['message'] for item in outbox_batch])
+                print(f"📥 Поставлено в очередь {len(outbox_batch)} сообщений, {queued} заданий на отправку")
+        await outbox.dispatch(bot)
+        if media_uploads.stats['uploads']:
+            print(f"📎 {media_uploads.report()}")
             
     except Exception as e:
         print(f"❌ Ошибка при обработке новых сообщений: {str(e)}")
 
 async def cleanup_channel_data(channel_id):
     try:
-        media_files_to_delete = set()
+        media_files_to_release = []
         messages_folder = config['sources']['telegram']['messages_folder']
         
         for filename in os.listdir(messages_folder):
@@ -304,7 +293,7 @@ async def cleanup_channel_data(channel_id):
                 
                 for msg in messages:
                     if msg['channel_id'] == channel_id and msg.get('media_path'):
-                        media_files_to_delete.add(msg['media_path'])
+                        media_files_to_release.append((msg['media_path'], media_store.get_message_owner(msg)))
                 
                 filtered_messages = [msg for msg in messages if msg['channel_id'] != channel_id]
                 
@@ -316,10 +305,10 @@ async def cleanup_channel_data(channel_id):
                     print(f"Удален пустой файл: {filename}")
         
         deleted_files = 0
-        for media_path in media_files_to_delete:
+        for media_path, owner in media_files_to_release:
             try:
-                if os.path.exists(media_path):
-                    os.remove(media_path)
+                # Файл из хранилища удаляется, только когда на него не ссылается ни одно сообщение
+                if await db.call(media_store.release, media_path, owner):
                     deleted_files += 1
             except Exception as e:
                 print(f"Ошибка при удалении файла {media_path}: {str(e)}")
@@ -401,8 +390,8 @@ async def get_last_message():
     except Exception as e:
         return None, f"Произошла ошибка при чтении сообщений: {str(e)}"
 
-def is_admin(user_id):
-    return db_is_admin(user_id)
+async def is_admin(user_id):
+    return await db.call(db_is_admin, user_id)
 
 async def get_admin_buttons():
     global parser_process
@@ -484,12 +473,11 @@ async def start_handler(event):
     user_id = event.sender_id
     username = event.sender.username
     
-    if not user_exists(user_id):
-        add_user(user_id, username)
-    
-    user = get_user(user_id)
+    exists, user = await db.call_many([(user_exists, user_id), (get_user, user_id)])
+    if not exists:
+        user = (await db.call_many([(add_user, user_id, username), (get_user, user_id)]))[1]
     
-    if is_admin(user_id):
+    if await is_admin(user_id):
         await update_admin_panel(event)
     else:
         if user and user['subscription_status']:
@@ -560,7 +548,7 @@ async def callback_handler(event):
     user_id = event.sender_id
     data = event.data.decode()
 
-    user = get_user(user_id)
+    user = await db.call(get_user, user_id)
     
     if not user:
         await event.answer("Ошибка: пользователь не найден")
@@ -591,9 +579,9 @@ async def callback_handler(event):
             await event.edit(about_text, buttons=[[Button.inline("◀️ Назад", b"back_to_main")]])
             
         elif data == "toggle_orders":
-            success = toggle_orders(user_id)
+            success, updated_user = await db.call_many([(toggle_orders, user_id), (get_user, user_id)])
             if success:
-                user = get_user(user_id)
+                user = updated_user
                 await event.answer(
                     "✅ Уведомления о заказах включены" if user['orders_enabled'] else "❌ Уведомления о заказах выключены",
                     alert=True
@@ -654,10 +642,13 @@ async def callback_handler(event):
             
             if source_type in ['tg', 'vk', 'site']:
                 current_status = user[source_type]
-                success = update_sources(user_id, source_type, not current_status)
+                success, updated_user = await db.call_many([
+                    (update_sources, user_id, source_type, not current_status),
+                    (get_user, user_id)
+                ])
                 
                 if success:
-                    user = get_user(user_id)
+                    user = updated_user
                     filters_text = f"""
 🎯 **Настройка источников заказов**
 
@@ -841,7 +832,7 @@ async def callback_handler(event):
         await event.edit(welcome_text, buttons=buttons)
         return
 
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await event.answer("У вас нет доступа к этой функции")
         return
 
@@ -1090,11 +1081,11 @@ async def callback_handler(event):
             failed_ids = []
             
             for user_id in user_ids:
-                user = get_user(user_id)
+                user = await db.call(get_user, user_id)
                 is_prolongation = user and user['subscription_status'] and user['subscription_end_date']
                 
-                if set_subscription(user_id, bot.subscription_duration):
-                    updated_user = get_user(user_id)
+                if await db.call(set_subscription, user_id, bot.subscription_duration):
+                    updated_user = await db.call(get_user, user_id)
                     success_ids.append(str(user_id))
                     
                     end_date = datetime.strptime(updated_user['subscription_end_date'], '%Y-%m-%d %H:%M:%S')
@@ -1138,7 +1129,7 @@ async def callback_handler(event):
             if success_ids:
                 report += "✅ Успешно выдано:\n"
                 for user_id in success_ids:
-                    user = get_user(int(user_id))
+                    user = await db.call(get_user, int(user_id))
                     if user:
                         end_date = datetime.strptime(user['subscription_end_date'], '%Y-%m-%d %H:%M:%S')
                         days_left = (end_date - datetime.now()).days
@@ -1153,7 +1144,7 @@ async def callback_handler(event):
             if failed_ids:
                 report += "❌ Не удалось выдать:\n"
                 for user_id in failed_ids:
-                    user = get_user(int(user_id))
+                    user = await db.call(get_user, int(user_id))
                     username = f"@{user['username']}" if user and user['username'] else "без username"
                     report += f"• {username} (ID: {user_id})\n"
             
@@ -1257,11 +1248,11 @@ async def message_handler(event):
             failed_ids = []
             
             for user_id in user_ids:
-                user = get_user(user_id)
+                user = await db.call(get_user, user_id)
                 is_prolongation = user and user['subscription_status'] and user['subscription_end_date']
                 
-                if set_subscription(user_id, bot.subscription_duration):
-                    updated_user = get_user(user_id)
+                if await db.call(set_subscription, user_id, bot.subscription_duration):
+                    updated_user = await db.call(get_user, user_id)
                     success_ids.append(str(user_id))
                     
                     end_date = datetime.strptime(updated_user['subscription_end_date'], '%Y-%m-%d %H:%M:%S')
@@ -1306,7 +1297,7 @@ async def message_handler(event):
             if success_ids:
                 report += "✅ Успешно выдано:\n"
                 for user_id in success_ids:
-                    user = get_user(int(user_id))
+                    user = await db.call(get_user, int(user_id))
                     if user:
                         end_date = datetime.strptime(user['subscription_end_date'], '%Y-%m-%d %H:%M:%S')
                         days_left = (end_date - datetime.now()).days
@@ -1319,7 +1310,7 @@ async def message_handler(event):
             if failed_ids:
                 report += "❌ Не удалось выдать:\n"
                 for user_id in failed_ids:
-                    user = get_user(int(user_id))
+                    user = await db.call(get_user, int(user_id))
                     username = f"@{user['username']}" if user and user['username'] else "без username"
                     report += f"• {username} (ID: {user_id})\n"
             
@@ -1339,7 +1330,7 @@ async def message_handler(event):
 @bot.on(events.NewMessage(pattern='/add_admin'))
 async def add_admin_handler(event):
     user_id = event.sender_id
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         return
     
     try:
@@ -1349,15 +1340,15 @@ async def add_admin_handler(event):
             return
         new_admin_id = int(command_args[1])
         
-        if not user_exists(new_admin_id):
+        if not await db.call(user_exists, new_admin_id):
             await event.respond("❌ Пользователь не найден в базе данных")
             return
             
-        if is_admin(new_admin_id):
+        if await is_admin(new_admin_id):
             await event.respond("❌ Пользователь уже является администратором")
             return
             
-        if set_admin(new_admin_id, True):
+        if await db.call(set_admin, new_admin_id, True):
             await event.respond(f"✅ Пользователь {new_admin_id} успешно назначен администратором")
         else:
             await event.respond("❌ Произошла ошибка при назначении администратора")
@@ -1370,7 +1361,7 @@ async def add_admin_handler(event):
 @bot.on(events.NewMessage(pattern='/remove_admin'))
 async def remove_admin_handler(event):
     user_id = event.sender_id
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         return
     
     try:
@@ -1380,15 +1371,15 @@ async def remove_admin_handler(event):
             return
         admin_id = int(command_args[1])
         
-        if not user_exists(admin_id):
+        if not await db.call(user_exists, admin_id):
             await event.respond("❌ Пользователь не найден в базе данных")
             return
             
-        if not is_admin(admin_id):
+        if not await is_admin(admin_id):
             await event.respond("❌ Пользователь не является администратором")
             return
             
-        if set_admin(admin_id, False):
+        if await db.call(set_admin, admin_id, False):
             await event.respond(f"✅ Пользователь {admin_id} больше не является администратором")
         else:
             await event.respond("❌ Произошла ошибка при удалении администратора")
@@ -1457,126 +1448,168 @@ async def update_admin_panel(event):
 
     await event.respond(panel_text, buttons=buttons)
 
-async def cleanup_sent_messages(file_path, messages):
+PARSERS = {
+    'telegram': {'module': 'tg_parser', 'name': 'Telegram', 'emoji': '💬'},
+    'vk': {'module': 'vk_parser', 'name': 'VK', 'emoji': '💬'},
+    'hh': {'module': 'hh_parser', 'name': 'HH', 'emoji': '💼'}
+}
+
+# Модули парсеров, загруженные в процесс бота (режим parser_mode = "inprocess")
+parser_modules = {}
+
+def get_parser_module(source):
+    if source not in parser_modules:
+        parser_modules[source] = importlib.import_module(PARSERS[source]['module'])
+    return parser_modules[source]
+
+async def run_parser_inprocess(source):
     try:
-        for message in messages:
-            if message.get('media_path') and os.path.exists(message['media_path']):
-                try:
-                    os.remove(message['media_path'])
-                    print(f"✅ Удален медиафайл: {message['media_path']}")
-                except Exception as e:
-                    print(f"❌ Ошибка при удалении медиафайла {message['media_path']}: {str(e)}")
-        
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"✅ Удален файл с сообщениями: {file_path}")
-            
-        print(f"✅ Очищены отправленные сообщения и медиафайлы")
-        cleanup_old_messages(30)
-        
+        module = get_parser_module(source)
+        return await module.main()
     except Exception as e:
-        print(f"❌ Ошибка при очистке сообщений: {str(e)}")
+        print(f"❌ Ошибка {PARSERS[source]['name']} парсера: {str(e)}")
+        return False
 
-async def parser_loop():
-    while is_running:
+async def run_parser_subprocess(source):
+    process = await asyncio.create_subprocess_exec(
+        'python', '-u', f"{PARSERS[source]['module']}.py",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, 'PYTHONIOENCODING': 'utf-8', 'PYTHONUNBUFFERED': '1'}
+    )
+    
+    try:
+        while True:
+            try:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                print(line.decode('utf-8', errors='ignore').strip())
+            except Exception as e:
+                print(f"Ошибка при чтении вывода {PARSERS[source]['name']} парсера: {str(e)}")
+                break
+        
+        return await process.wait() == 0
+    finally:
+        if process.returncode is None:
+            kill_process_tree(process.pid)
+
+async def run_source_parser(source):
+    print(f"\n{PARSERS[source]['emoji']} Запуск {PARSERS[source]['name']} парсера...")
+    if config.get('parser_mode', 'subprocess') == 'inprocess':
+        return await run_parser_inprocess(source)
+    return await run_parser_subprocess(source)
+
+async def close_parsers():
+    for source, module in list(parser_modules.items()):
         try:
-            if config['sources']['telegram'].get('enabled'):
-                print("\n💬 Запуск Telegram парсера...")
-                tg_process = await asyncio.create_subprocess_exec(
-                    'python', '-u', 'tg_parser.py',
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    env={**os.environ, 'PYTHONIOENCODING': 'utf-8', 'PYTHONUNBUFFERED': '1'}
-                )
-                
-                while True:
-                    try:
-                        line = await tg_process.stdout.readline()
-                        if not line:
-                            break
-                        print(line.decode('utf-8', errors='ignore').strip())
-                    except Exception as e:
-                        print(f"Ошибка при чтении вывода Telegram парсера: {str(e)}")
-                        break
-                
-                await tg_process.wait()
-                await process_new_messages('telegram')
-            
-            if config['sources']['vk'].get('enabled'):
-                print("\n💬 Запуск VK парсера...")
-                vk_process = await asyncio.create_subprocess_exec(
-                    'python', '-u', 'vk_parser.py',
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    env={**os.environ, 'PYTHONIOENCODING': 'utf-8', 'PYTHONUNBUFFERED': '1'}
-                )
-                
-                while True:
-                    try:
-                        line = await vk_process.stdout.readline()
-                        if not line:
-                            break
-                        print(line.decode('utf-8', errors='ignore').strip())
-                    except Exception as e:
-                        print(f"Ошибка при чтении вывода VK парсера: {str(e)}")
-                        break
-                
-                await vk_process.wait()
-                await process_new_messages('vk')
-            
-            if config['sources']['hh'].get('enabled'):
-                print("\n💼 Запуск HH парсера...")
-                hh_process = await asyncio.create_subprocess_exec(
-                    'python', '-u', 'hh_parser.py',
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    env={**os.environ, 'PYTHONIOENCODING': 'utf-8', 'PYTHONUNBUFFERED': '1'}
-                )
-                
-                while True:
-                    try:
-                        line = await hh_process.stdout.readline()
-                        if not line:
-                            break
-                        print(line.decode('utf-8', errors='ignore').strip())
-                    except Exception as e:
-                        print(f"Ошибка при чтении вывода HH парсера: {str(e)}")
-                        break
-                
-                await hh_process.wait()
-                await process_new_messages('hh')
-            
-            await asyncio.sleep(120)
-            
+            await module.close()
         except Exception as e:
-            print(f"Ошибка в цикле парсера: {str(e)}")
-            await asyncio.sleep(60)
+            print(f"Ошибка при остановке {PARSERS[source]['name']} парсера: {str(e)}")
+    parser_modules.clear()
+
+# Значения по умолчанию для config['sources'][source]: interval, jitter, timeout (в секундах)
+DEFAULT_SCHEDULE = {'interval': 120, 'jitter': 0, 'timeout': 300}
+
+def get_source_schedule(source):
+    source_config = config['sources'].get(source, {})
+    return {key: source_config.get(key, value) for key, value in DEFAULT_SCHEDULE.items()}
+
+def is_stream_mode(source):
+    return (source == 'telegram'
+            and config.get('parser_mode', 'subprocess') == 'inprocess'
+            and config['sources'][source].get('mode') == 'stream')
+
+async def on_stream_message(message):
+    recipients = await db.call(get_recipients, 'telegram')
+    if not recipients:
+        print("Нет пользователей с активной подпиской на источник telegram")
+        return
+    await deliver_message('telegram', message, recipients)
+
+async def run_source_cycle(source):
+    # Запуск парсера и рассылка найденного вместе ограничены timeout источника.
+    # Прерванная рассылка продолжится из очереди outbox в следующем цикле
+    await run_source_parser(source)
+    await process_new_messages(source)
+
+async def run_source_stream(source, schedule):
+    async def catch_up():
+        # Догоняем сообщения, опубликованные пока подписка не работала
+        try:
+            await asyncio.wait_for(run_source_cycle(source), timeout=schedule['timeout'])
+        except asyncio.TimeoutError:
+            print(f"⏱ Цикл {PARSERS[source]['name']} парсера не уложился в {schedule['timeout']} с и прерван")
+    
+    try:
+        module = get_parser_module(source)
+        await module.stream(on_stream_message, catch_up)
+    except Exception as e:
+        print(f"Ошибка в потоке {PARSERS[source]['name']} парсера: {str(e)}")
+
+async def source_loop(source):
+    while is_running:
+        get_config()
+        schedule = get_source_schedule(source)
+        
+        if config['sources'].get(source, {}).get('enabled') and is_stream_mode(source):
+            await run_source_stream(source, schedule)
+        elif config['sources'].get(source, {}).get('enabled'):
+            try:
+                started = asyncio.get_running_loop().time()
+                await asyncio.wait_for(run_source_cycle(source), timeout=schedule['timeout'])
+                elapsed = asyncio.get_running_loop().time() - started
+                print(f"⏱ Цикл {PARSERS[source]['name']} парсера завершен за {elapsed:.1f} с")
+            except asyncio.TimeoutError:
+                print(f"⏱ Цикл {PARSERS[source]['name']} парсера не уложился в {schedule['timeout']} с и прерван")
+            except Exception as e:
+                print(f"Ошибка в цикле {PARSERS[source]['name']} парсера: {str(e)}")
+        
+        await asyncio.sleep(schedule['interval'] + random.uniform(0, schedule['jitter']))
+
+async def parser_loop():
+    try:
+        await asyncio.gather(*(source_loop(source) for source in PARSERS))
+    finally:
+        await close_parsers()
 
 async def main():
+    global parser_process
     print("Бот запущен. Нажмите Ctrl+C для остановки")
     
+    outbox_task = None
     try:
         await bot.start(bot_token=config['bot_token'])
+        # Досылаем задания, оставшиеся в очереди после прошлого запуска
+        outbox_task = asyncio.ensure_future(outbox.dispatch(bot))
         await bot.run_until_disconnected()
     except KeyboardInterrupt:
         print("\nПолучен сигнал завершения...")
     except Exception as e:
         print(f"Произошла ошибка: {str(e)}")
     finally:
+        if outbox_task is not None:
+            # Неотправленные задания остаются в очереди до следующего запуска
+            outbox_task.cancel()
+            try:
+                await outbox_task
+            except asyncio.CancelledError:
+                pass
         if parser_process:
             kill_process_tree(parser_process.pid)
             parser_process = None
         await bot.disconnect()
+        db.close()
         print("Бот остановлен")
 
 @bot.on(events.NewMessage(pattern='/stats'))
 async def stats_handler(event):
     user_id = event.sender_id
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         return
         
     try:
-        stats = get_sent_messages_stats()
+        stats, outbox_stats = await db.call_many([(get_sent_messages_stats,), (get_outbox_stats,)])
         stats_text = f"""
 📊 **Статистика отправленных сообщений**
 
@@ -1588,6 +1621,15 @@ async def stats_handler(event):
         for source, count in stats['by_source'].items():
             emoji = "📢" if source == "telegram" else "💬" if source == "vk" else "🌐"
             stats_text += f"\n{emoji} {source.title()}: {count}"
+        
+        stats_text += (f"\n\n📬 Очередь рассылки: ожидают {outbox_stats.get('pending', 0)}, "
+                       f"доставлено {outbox_stats.get('sent', 0)}, не доставлено {outbox_stats.get('failed', 0)}")
+        stats_text += (f"\n🔎 Проверок «уже отправлено» с запуска: {sent_index.stats['checks']}, "
+                       f"из них с запросом к базе: {sent_index.stats['db_lookups']}")
+        stats_text += (f"\n👥 Кэш получателей: {audience_cache.stats['hits']} попаданий, "
+                       f"{audience_cache.stats['rebuilds']} пересборок")
+        stats_text += (f"\n🗄 Поток базы данных: {db.stats['requests']} запросов в {db.stats['batches']} пачках, "
+                       f"самая большая пачка: {db.stats['max_batch']}")
             
         await event.respond(stats_text)
             
@@ -1597,7 +1639,7 @@ async def stats_handler(event):
 @bot.on(events.NewMessage(pattern='/reset_subscription'))
 async def reset_subscription_handler(event):
     user_id = event.sender_id
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         return
     
     try:
@@ -1607,14 +1649,14 @@ async def reset_subscription_handler(event):
             return
             
         target_user_id = int(command_args[1])
-        if not user_exists(target_user_id):
+        if not await db.call(user_exists, target_user_id):
             await event.respond("❌ Пользователь не найден в базе данных")
             return
             
-        user = get_user(target_user_id)
+        user = await db.call(get_user, target_user_id)
         username = f"@{user['username']}" if user['username'] else "без username"
         
-        if reset_subscription(target_user_id):
+        if await db.call(reset_subscription, target_user_id):
             await event.respond(f"✅ Подписка пользователя {username} (ID: {target_user_id}) успешно обнулена")
             
             try:
@@ -1653,21 +1695,5 @@ def get_duration_text(duration: float) -> str:
     else:
         return f"{duration} месяцев"
 
-def cleanup_old_messages(days: int):
-    try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-        c.execute('DELETE FROM sent_messages WHERE sent_date < ?', (cutoff_date,))
-        deleted_count = c.rowcount
-        conn.commit()
-        conn.close()
-        
-        if deleted_count > 0:
-            print(f"✅ Удалено {deleted_count} старых сообщений из базы данных")
-            
-    except Exception as e:
-        print(f"❌ Ошибка при очистке старых сообщений: {str(e)}")
-
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
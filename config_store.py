@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from json_store import save_json
+from keyword_filter import KeywordFilter, get_filter
+
+CONFIG_FILE = 'config.json'
+EXAMPLE_CONFIG_FILE = 'config.example.json'
+
+# Ключ, под которым в настройках источника хранятся его каналы/группы
+SOURCE_ITEMS = {'telegram': 'channels', 'vk': 'groups'}
+
+# Один общий словарь на процесс: при перечитывании файла он обновляется на месте,
+# поэтому все модули, получившие его через get_config(), видят актуальные настройки
+_config: Dict = {}
+_snapshot = {'path': None, 'mtime': None, 'hash': None}
+_filters: Dict = {}
+_lock = threading.RLock()
+
+def get_config_path() -> str:
+    if os.path.exists(CONFIG_FILE):
+        return CONFIG_FILE
+    return EXAMPLE_CONFIG_FILE
+
+def _reload(path: str, mtime: int):
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    if path != _snapshot['path'] and path == EXAMPLE_CONFIG_FILE:
+        print(f"⚠️ Файл config.json не найден, используем {path}")
+        print("⚠️ Создайте файл config.json на основе примера и заполните его вашими данными")
+
+    if digest != _snapshot['hash']:
+        try:
+            config = json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            if not _config:
+                raise
+            print(f"❌ Ошибка в файле {path}, продолжаем со старыми настройками: {str(e)}")
+            return
+        _config.clear()
+        _config.update(config)
+        _filters.clear()
+        _snapshot['hash'] = digest
+
+    _snapshot['path'] = path
+    _snapshot['mtime'] = mtime
+
+def get_config() -> Dict:
+    with _lock:
+        path = get_config_path()
+        mtime = os.stat(path).st_mtime_ns
+        if path != _snapshot['path'] or mtime != _snapshot['mtime']:
+            _reload(path, mtime)
+        return _config
+
+def save_config(config: Optional[Dict] = None):
+    with _lock:
+        if config is not None and config is not _config:
+            _config.clear()
+            _config.update(config)
+        save_json(CONFIG_FILE, _config)
+        _filters.clear()
+        with open(CONFIG_FILE, 'rb') as f:
+            _snapshot['hash'] = hashlib.sha256(f.read()).hexdigest()
+        _snapshot['path'] = CONFIG_FILE
+        _snapshot['mtime'] = os.stat(CONFIG_FILE).st_mtime_ns
+
+def get_source_config(source: str) -> Dict:
+    return get_config().get('sources', {}).get(source, {})
+
+def get_source_filter(source: str, item_id: Optional[str] = None) -> KeywordFilter:
+    config = get_config()
+    with _lock:
+        key = (source, item_id)
+        if key not in _filters:
+            settings = config.get('sources', {}).get(source, {})
+            if item_id is not None:
+                settings = settings.get(SOURCE_ITEMS[source], {}).get(str(item_id), {})
+            _filters[key] = get_filter(settings.get('include_filters', []), settings.get('exclude_filters', []))
+        return _filters[key]
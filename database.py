@@ -1,13 +1,33 @@
 import sqlite3
 from datetime import datetime, timedelta
-import threading
+import hashlib
 import json
+import math
+import os
+import threading
+from config_store import get_config
+
+DB_PATH = 'users.db'
 
 thread_local = threading.local()
 
+# Настройки соединения, которые SQLite не сохраняет в файле базы: NORMAL в режиме WAL не теряет
+# согласованность при сбое, кэш страниц 20 МБ, чтение через отображение файла в память до 256 МБ
+CONNECTION_PRAGMAS = [
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -20000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY'
+]
+
+def configure_connection(conn):
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 def get_db_connection():
     if not hasattr(thread_local, "connection"):
-        thread_local.connection = sqlite3.connect('users.db', timeout=20)
+        thread_local.connection = configure_connection(sqlite3.connect(DB_PATH, timeout=20))
     return thread_local.connection
 
 def close_db_connection():
@@ -16,6 +36,9 @@ def close_db_connection():
         del thread_local.connection
 
 class DatabaseConnection:
+    def __init__(self, on_commit=None):
+        self.on_commit = on_commit
+        
     def __enter__(self):
         self.conn = get_db_connection()
         return self.conn
@@ -23,53 +46,289 @@ class DatabaseConnection:
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is None:
             self.conn.commit()
+            if self.on_commit:
+                self.on_commit()
         else:
             self.conn.rollback()
 
+# Поле пользователя, отвечающее за подписку на источник
+SOURCE_FLAGS = {'telegram': 'tg', 'vk': 'vk', 'hh': 'site', 'site': 'site'}
+
+class AudienceCache:
+    # Подписчики и готовые списки получателей по источникам. Сбрасывается функциями, меняющими
+    # пользователей, и пересчитывается сам, когда истекает ближайшая из активных подписок
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = None
+        self.recipients = None
+        self.valid_until = None
+        self.stats = {'hits': 0, 'rebuilds': 0}
+
+    def invalidate(self):
+        with self.lock:
+            self.users = None
+            self.recipients = None
+
+    def _load(self, current_time: str):
+        with DatabaseConnection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT user_id, username, orders_enabled, tg, vk, site, subscription_end_date 
+                FROM users 
+                WHERE subscription_status = 1 
+                AND (subscription_end_date IS NULL OR subscription_end_date > ?)
+            ''', (current_time,))
+            rows = c.fetchall()
+        
+        users = []
+        for row in rows:
+            users.append({
+                'user_id': row[0],
+                'username': row[1],
+                'orders_enabled': bool(row[2]),
+                'tg': bool(row[3]),
+                'vk': bool(row[4]),
+                'site': bool(row[5])
+            })
+        self.users = users
+        self.recipients = {
+            source: tuple(user['user_id'] for user in users if user['orders_enabled'] and user[flag])
+            for source, flag in SOURCE_FLAGS.items()
+        }
+        self.valid_until = min((row[6] for row in rows if row[6]), default=None)
+        self.stats['rebuilds'] += 1
+
+    def get(self):
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            if self.users is None or (self.valid_until and current_time >= self.valid_until):
+                self._load(current_time)
+            else:
+                self.stats['hits'] += 1
+            return self.users, self.recipients
+
+audience_cache = AudienceCache()
+
+class SentMessagesIndex:
+    # Фильтр Блума по message_id из sent_messages. Отрицательный ответ точный и не требует запроса к базе,
+    # положительный подтверждается поиском по первичному ключу. Биты сохраняются в файл вместе с rowid
+    # последней учтенной записи, так что при запуске из базы дочитываются только новые строки
+    def __init__(self, path: str = 'sent_index.bin', capacity: int = 1000000, error_rate: float = 0.01):
+        self.path = path
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.last_rowid = 0
+        self.last_id = None
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.stats = {'checks': 0, 'db_lookups': 0}
+
+    def _positions(self, message_id: str):
+        digest = hashlib.blake2b(message_id.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def _add(self, message_id: str):
+        for position in self._positions(message_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def add(self, message_id: str):
+        with self.lock:
+            if self.loaded:
+                self._add(message_id)
+
+    def might_contain(self, message_id: str) -> bool:
+        self.ensure_loaded()
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(message_id))
+
+    def _read_file(self) -> bool:
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                bits = f.read()
+        except (OSError, ValueError):
+            return False
+        if header.get('size') != self.size or header.get('hashes') != self.hashes or len(bits) != len(self.bits):
+            return False
+        self.bits = bytearray(bits)
+        self.last_rowid = header.get('last_rowid', 0)
+        self.last_id = header.get('last_id')
+        return True
+
+    def _write_file(self):
+        header = {'size': self.size, 'hashes': self.hashes, 'last_rowid': self.last_rowid, 'last_id': self.last_id}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(self.bits)
+        os.replace(tmp_path, self.path)
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            with DatabaseConnection() as conn:
+                c = conn.cursor()
+                restored = self._read_file()
+                if restored and self.last_id is not None:
+                    # Если rowid сменились (например, после VACUUM), снимок больше не соответствует базе
+                    c.execute('SELECT message_id FROM sent_messages WHERE rowid = ?', (self.last_rowid,))
+                    row = c.fetchone()
+                    restored = bool(row) and row[0] == self.last_id
+                if not restored:
+                    self.bits = bytearray(len(self.bits))
+                    self.last_rowid = 0
+                    self.last_id = None
+                
+                c.execute('SELECT rowid, message_id FROM sent_messages WHERE rowid > ? ORDER BY rowid', (self.last_rowid,))
+                added = 0
+                for rowid, message_id in c:
+                    self._add(message_id)
+                    self.last_rowid, self.last_id = rowid, message_id
+                    added += 1
+            
+            if added or not restored:
+                try:
+                    self._write_file()
+                except OSError as e:
+                    print(f"Ошибка при сохранении индекса отправленных сообщений: {e}")
+            self.loaded = True
+
+sent_index = SentMessagesIndex()
+
+# Миграции схемы: каждая выполняется один раз, номер последней примененной хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            subscription_status INTEGER DEFAULT 0,
+            subscription_end_date TEXT,
+            subscription_duration INTEGER DEFAULT 0,
+            orders_enabled INTEGER DEFAULT 0,
+            site INTEGER DEFAULT 0,
+            vk INTEGER DEFAULT 0,
+            tg INTEGER DEFAULT 0,
+            registration_date TEXT NOT NULL,
+            role TEXT DEFAULT 'user'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sent_messages (
+            message_id TEXT PRIMARY KEY,
+            channel_id TEXT,
+            source TEXT,
+            text TEXT,
+            media_path TEXT,
+            sent_date TEXT,
+            parsed_date TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS media_files (
+            digest TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER,
+            refs INTEGER DEFAULT 0,
+            created_date TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS media_keys (
+            media_key TEXT PRIMARY KEY,
+            digest TEXT NOT NULL
+        )
+        '''
+    ]),
+    (2, [
+        'PRAGMA journal_mode = WAL',
+        'CREATE INDEX IF NOT EXISTS idx_sent_messages_sent_date ON sent_messages (sent_date)',
+        'CREATE INDEX IF NOT EXISTS idx_sent_messages_source ON sent_messages (source)',
+        'CREATE INDEX IF NOT EXISTS idx_users_subscription ON users (subscription_status, subscription_end_date)'
+    ]),
+    (3, [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox_messages (
+            message_id TEXT PRIMARY KEY,
+            source TEXT,
+            text TEXT,
+            media_path TEXT,
+            created_date TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            message_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_retry_at TEXT,
+            updated_date TEXT,
+            PRIMARY KEY (message_id, user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_retry_at)'
+    ]),
+    # Ссылки на медиафайлы хранятся парами (владелец, файл), а не счетчиком media_files.refs:
+    # повторная обработка того же поста парсером не добавляет ссылку. Прежние ссылки сообщений
+    # не восстановить, переносятся только ссылки очереди рассылки
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS media_refs (
+            owner TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (owner, digest)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_media_refs_digest ON media_refs (digest)',
+        '''
+        INSERT OR IGNORE INTO media_refs (owner, digest) 
+        SELECT 'outbox:' || m.message_id, f.digest 
+        FROM outbox_messages m JOIN media_files f ON f.path = m.media_path 
+        WHERE m.media_path IS NOT NULL
+        '''
+    ]),
+    # Освобождение медиафайла, очередь рассылки и forget_media ищут запись по пути файла.
+    # Путь строится из SHA-256 содержимого, поэтому дубликатов в уже существующих базах нет
+    (5, [
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_media_files_path ON media_files (path)'
+    ])
+]
+
+def migrate(conn, target: int = None):
+    c = conn.cursor()
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    for migration_version, statements in MIGRATIONS:
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        for statement in statements:
+            c.execute(statement)
+        c.execute(f'PRAGMA user_version = {migration_version}')
+        conn.commit()
+        version = migration_version
+    return version
+
 def init_db():
+    migrate(get_db_connection())
+    
     with DatabaseConnection() as conn:
         c = conn.cursor()
         
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                subscription_status INTEGER DEFAULT 0,
-                subscription_end_date TEXT,
-                subscription_duration INTEGER DEFAULT 0,
-                orders_enabled INTEGER DEFAULT 0,
-                site INTEGER DEFAULT 0,
-                vk INTEGER DEFAULT 0,
-                tg INTEGER DEFAULT 0,
-                registration_date TEXT NOT NULL,
-                role TEXT DEFAULT 'user'
-            )
-        ''')
-        
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS sent_messages (
-                message_id TEXT PRIMARY KEY,
-                channel_id TEXT,
-                source TEXT,
-                text TEXT,
-                media_path TEXT,
-                sent_date TEXT,
-                parsed_date TEXT
-            )
-        ''')
+        admin_ids = get_config().get('admins', [])
         
-        with open('config.json', 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            admin_ids = config.get('admins', [])
-            
-            for admin_id in admin_ids:
-                c.execute('SELECT 1 FROM users WHERE user_id = ?', (admin_id,))
-                if not c.fetchone():
-                    c.execute('''
-                        INSERT INTO users 
-                        (user_id, registration_date, role) 
-                        VALUES (?, ?, ?)
-                    ''', (admin_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'admin'))
+        for admin_id in admin_ids:
+            c.execute('SELECT 1 FROM users WHERE user_id = ?', (admin_id,))
+            if not c.fetchone():
+                c.execute('''
+                    INSERT INTO users 
+                    (user_id, registration_date, role) 
+                    VALUES (?, ?, ?)
+                ''', (admin_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'admin'))
 
 def add_user(user_id: int, username: str):
     try:
@@ -104,6 +363,8 @@ def get_user(user_id: int):
                                 subscription_duration = 0 
                             WHERE user_id = ?
                         ''', (user_id,))
+                        conn.commit()
+                        audience_cache.invalidate()
                         user = list(user)
                         user[2] = 0
                         user[3] = None
@@ -157,7 +418,7 @@ def set_admin(user_id: int, is_admin: bool = True):
 
 def set_subscription(user_id: int, duration_months: float):
     try:
-        with DatabaseConnection() as conn:
+        with DatabaseConnection(on_commit=audience_cache.invalidate) as conn:
             c = conn.cursor()
             
             c.execute('''
@@ -197,7 +458,7 @@ def set_subscription(user_id: int, duration_months: float):
 
 def toggle_orders(user_id: int, status: bool = None):
     try:
-        with DatabaseConnection() as conn:
+        with DatabaseConnection(on_commit=audience_cache.invalidate) as conn:
             c = conn.cursor()
             if status is None:
                 c.execute('SELECT orders_enabled FROM users WHERE user_id = ?', (user_id,))
@@ -221,7 +482,7 @@ def update_sources(user_id: int, source_type: str, status: bool):
         return False
         
     try:
-        with DatabaseConnection() as conn:
+        with DatabaseConnection(on_commit=audience_cache.invalidate) as conn:
             c = conn.cursor()
             c.execute(f'''
                 UPDATE users 
@@ -235,7 +496,7 @@ def update_sources(user_id: int, source_type: str, status: bool):
 
 def set_all_sources(user_id: int, status: bool):
     try:
-        with DatabaseConnection() as conn:
+        with DatabaseConnection(on_commit=audience_cache.invalidate) as conn:
             c = conn.cursor()
             c.execute('''
                 UPDATE users 
@@ -247,76 +508,169 @@ def set_all_sources(user_id: int, status: bool):
         print(f"Ошибка при обновлении всех источников: {e}")
         return False
 
-def get_all_subscribed_users():
+def get_recipients(source: str) -> tuple:
+    try:
+        _, recipients = audience_cache.get()
+        return recipients.get(source, ())
+    except Exception as e:
+        print(f"Ошибка при получении списка получателей: {str(e)}")
+        return ()
+
+def _sent_message_row(message_data: dict, current_time: str) -> tuple:
+    if message_data['source'] == 'hh':
+        source_id = 'hh'
+        message_id = str(message_data['vacancy_id'])
+        text = f"{message_data['title']}\n{message_data.get('description', '')}"
+    else:
+        source_id = str(message_data.get('channel_id') or message_data.get('owner_id'))
+        message_id = str(message_data['message_id'])
+        text = message_data.get('text', '')
+    
+    unique_id = f"{message_data['source']}_{source_id}_{message_id}"
+    return (
+        unique_id,
+        source_id,
+        message_data['source'],
+        text,
+        message_data.get('media_path'),
+        current_time,
+        message_data.get('date')
+    )
+
+def is_message_sent(source: str, channel_id: str, message_id: str) -> bool:
+    unique_id = f"{source}_{channel_id}_{message_id}"
+    sent_index.stats['checks'] += 1
+    if not sent_index.might_contain(unique_id):
+        return False
+    
+    sent_index.stats['db_lookups'] += 1
+    with DatabaseConnection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT 1 FROM sent_messages WHERE message_id = ?', (unique_id,))
+        return bool(c.fetchone())
+
+def enqueue_outbox(items: list) -> int:
+    # Сообщение отмечается отправленным и раскладывается на задания по получателям в одной транзакции:
+    # после перезапуска рассылка продолжается по заданиям, а повторно в очередь сообщение не попадет.
+    # Пока задания не выполнены, очередь держит ссылку на медиафайл в хранилище.
+    # Элемент: {'message': данные сообщения, 'text': готовый текст, 'media_path': файл или None, 'recipients': id}
+    if not items:
+        return 0
     try:
         with DatabaseConnection() as conn:
             c = conn.cursor()
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            c.execute('''
-                SELECT user_id, username, orders_enabled, tg, vk, site 
-                FROM users 
-                WHERE subscription_status = 1 
-                AND (subscription_end_date IS NULL OR subscription_end_date > ?)
-            ''', (current_time,))
-            
-            users = []
-            for row in c.fetchall():
-                users.append({
-                    'user_id': row[0],
-                    'username': row[1],
-                    'orders_enabled': bool(row[2]),
-                    'tg': bool(row[3]),
-                    'vk': bool(row[4]),
-                    'site': bool(row[5])
-                })
-            return users
-            
+            jobs = []
+            for item in items:
+                row = _sent_message_row(item['message'], current_time)
+                c.execute('''
+                    INSERT OR IGNORE INTO sent_messages 
+                    (message_id, channel_id, source, text, media_path, sent_date, parsed_date) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', row)
+                if c.rowcount == 0:
+                    continue
+                sent_index.add(row[0])
+                media_path = item.get('media_path') if item['recipients'] else None
+                c.execute('''
+                    INSERT OR REPLACE INTO outbox_messages 
+                    (message_id, source, text, media_path, created_date) 
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (row[0], row[2], item['text'], media_path, current_time))
+                if media_path:
+                    c.execute('''
+                        INSERT OR IGNORE INTO media_refs (owner, digest) 
+                        SELECT ?, digest FROM media_files WHERE path = ?
+                    ''', (f"outbox:{row[0]}", media_path))
+                jobs.extend((row[0], user_id, current_time, current_time) for user_id in item['recipients'])
+            c.executemany('''
+                INSERT OR IGNORE INTO outbox 
+                (message_id, user_id, status, attempts, next_retry_at, updated_date) 
+                VALUES (?, ?, 'pending', 0, ?, ?)
+            ''', jobs)
+            return len(jobs)
     except Exception as e:
-        print(f"Ошибка при получении списка пользователей: {str(e)}")
-        return []
+        print(f"Ошибка при постановке сообщений в очередь рассылки: {e}")
+        return 0
 
-def add_sent_message(message_data: dict):
+def fetch_outbox(limit: int = 500) -> list:
     try:
         with DatabaseConnection() as conn:
             c = conn.cursor()
-            
-            if message_data['source'] == 'hh':
-                source_id = 'hh'
-                message_id = str(message_data['vacancy_id'])
-                text = f"{message_data['title']}\n{message_data.get('description', '')}"
-            else:
-                source_id = str(message_data.get('channel_id') or message_data.get('owner_id'))
-                message_id = str(message_data['message_id'])
-                text = message_data.get('text', '')
-            
-            unique_id = f"{message_data['source']}_{source_id}_{message_id}"
-            
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             c.execute('''
-                INSERT OR IGNORE INTO sent_messages 
-                (message_id, channel_id, source, text, media_path, sent_date, parsed_date) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                unique_id,
-                source_id,
-                message_data['source'],
-                text,
-                message_data.get('media_path'),
-                current_time,
-                message_data.get('date')
-            ))
+                SELECT o.message_id, o.user_id, o.attempts, m.text, m.media_path 
+                FROM outbox o 
+                JOIN outbox_messages m ON m.message_id = o.message_id 
+                WHERE o.status = 'pending' AND o.next_retry_at <= ? 
+                ORDER BY o.rowid 
+                LIMIT ?
+            ''', (current_time, limit))
+            return [
+                {'message_id': row[0], 'user_id': row[1], 'attempts': row[2], 'text': row[3], 'media_path': row[4]}
+                for row in c.fetchall()
+            ]
+    except Exception as e:
+        print(f"Ошибка при чтении очереди рассылки: {e}")
+        return []
+
+def complete_outbox(results: list, max_attempts: int = 5, retry_delay: float = 60) -> bool:
+    # results: (message_id, user_id, attempts, доставлено). Неудачное задание повторяется с удвоением
+    # паузы, после max_attempts попыток получает статус failed
+    if not results:
+        return True
+    try:
+        with DatabaseConnection() as conn:
+            c = conn.cursor()
+            now = datetime.now()
+            current_time = now.strftime('%Y-%m-%d %H:%M:%S')
+            updates = []
+            for message_id, user_id, attempts, delivered in results:
+                if delivered:
+                    status, next_retry_at = 'sent', None
+                elif attempts + 1 >= max_attempts:
+                    status, next_retry_at = 'failed', None
+                else:
+                    status = 'pending'
+                    next_retry_at = (now + timedelta(seconds=retry_delay * 2 ** attempts)).strftime('%Y-%m-%d %H:%M:%S')
+                updates.append((status, next_retry_at, current_time, message_id, user_id))
+            c.executemany('''
+                UPDATE outbox 
+                SET status = ?, attempts = attempts + 1, next_retry_at = COALESCE(?, next_retry_at), updated_date = ? 
+                WHERE message_id = ? AND user_id = ?
+            ''', updates)
             return True
     except Exception as e:
-        print(f"Ошибка при добавлении сообщения в историю: {e}")
+        print(f"Ошибка при сохранении результатов рассылки: {e}")
         return False
 
-def is_message_sent(source: str, channel_id: str, message_id: str) -> bool:
+def release_outbox_media() -> list:
+    # Снимает ссылки очереди с медиафайлов сообщений, у которых не осталось неотправленных заданий.
+    # Возвращает пути файлов, на которые больше никто не ссылается
+    try:
+        with DatabaseConnection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT m.message_id, m.media_path 
+                FROM outbox_messages m 
+                WHERE m.media_path IS NOT NULL 
+                AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.message_id = m.message_id AND o.status = 'pending')
+            ''')
+            unused = []
+            for message_id, path in c.fetchall():
+                c.execute('UPDATE outbox_messages SET media_path = NULL WHERE message_id = ?', (message_id,))
+                if _release_media_ref(c, path, f"outbox:{message_id}"):
+                    unused.append(path)
+            return unused
+    except Exception as e:
+        print(f"Ошибка при освобождении медиафайлов рассылки: {e}")
+        return []
+
+def get_outbox_stats() -> dict:
     with DatabaseConnection() as conn:
         c = conn.cursor()
-        unique_id = f"{source}_{channel_id}_{message_id}"
-        c.execute('SELECT 1 FROM sent_messages WHERE message_id = ?', (unique_id,))
-        return bool(c.fetchone())
+        c.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status')
+        return dict(c.fetchall())
 
 def get_sent_messages_stats():
     with DatabaseConnection() as conn:
@@ -344,14 +698,85 @@ def cleanup_old_messages(days: int = 30):
             c = conn.cursor()
             cleanup_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
             c.execute('DELETE FROM sent_messages WHERE sent_date < ?', (cleanup_date,))
+            if c.rowcount > 0:
+                print(f"✅ Удалено {c.rowcount} старых сообщений из базы данных")
+            # Незавершенные задания рассылки не удаляются, даже если они старше срока, а сообщение
+            # удаляется только после того, как очередь отпустила его медиафайл
+            c.execute("DELETE FROM outbox WHERE status != 'pending' AND updated_date < ?", (cleanup_date,))
+            c.execute('''
+                DELETE FROM outbox_messages 
+                WHERE created_date < ? AND media_path IS NULL AND message_id NOT IN (SELECT message_id FROM outbox)
+            ''', (cleanup_date,))
             return True
     except Exception as e:
         print(f"Ошибка при очистке старых сообщений: {e}")
         return False
 
-def reset_subscription(user_id: int) -> bool:
+def _release_media_ref(c, path: str, owner: str):
+    # True, если на файл больше никто не ссылается и его запись удалена; None для файлов вне хранилища
+    c.execute('SELECT digest FROM media_files WHERE path = ?', (path,))
+    row = c.fetchone()
+    if not row:
+        return None
+    c.execute('DELETE FROM media_refs WHERE owner = ? AND digest = ?', (owner, row[0]))
+    c.execute('SELECT 1 FROM media_refs WHERE digest = ? LIMIT 1', (row[0],))
+    if c.fetchone():
+        return False
+    c.execute('DELETE FROM media_keys WHERE digest = ?', (row[0],))
+    c.execute('DELETE FROM media_files WHERE digest = ?', (row[0],))
+    return True
+
+def acquire_media(media_key: str, owner: str):
     try:
         with DatabaseConnection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT f.digest, f.path 
+                FROM media_keys k JOIN media_files f ON f.digest = k.digest 
+                WHERE k.media_key = ?
+            ''', (media_key,))
+            row = c.fetchone()
+            if not row:
+                return None
+            c.execute('INSERT OR IGNORE INTO media_refs (owner, digest) VALUES (?, ?)', (owner, row[0]))
+            return row[1]
+    except Exception as e:
+        print(f"Ошибка при поиске медиафайла: {e}")
+        return None
+
+def add_media(digest: str, path: str, size: int, owner: str, media_key: str = None) -> str:
+    with DatabaseConnection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR IGNORE INTO media_files 
+            (digest, path, size, refs, created_date) 
+            VALUES (?, ?, ?, 0, ?)
+        ''', (digest, path, size, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        c.execute('INSERT OR IGNORE INTO media_refs (owner, digest) VALUES (?, ?)', (owner, digest))
+        if media_key:
+            c.execute('INSERT OR REPLACE INTO media_keys (media_key, digest) VALUES (?, ?)', (media_key, digest))
+        c.execute('SELECT path FROM media_files WHERE digest = ?', (digest,))
+        return c.fetchone()[0]
+
+def forget_media(path: str):
+    with DatabaseConnection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM media_keys WHERE digest IN (SELECT digest FROM media_files WHERE path = ?)', (path,))
+        c.execute('DELETE FROM media_refs WHERE digest IN (SELECT digest FROM media_files WHERE path = ?)', (path,))
+        c.execute('DELETE FROM media_files WHERE path = ?', (path,))
+
+def release_media(path: str, owner: str):
+    # Возвращает True, если ссылок на файл больше нет и его можно удалить, None для файлов вне хранилища
+    try:
+        with DatabaseConnection() as conn:
+            return _release_media_ref(conn.cursor(), path, owner)
+    except Exception as e:
+        print(f"Ошибка при освобождении медиафайла: {e}")
+        return False
+
+def reset_subscription(user_id: int) -> bool:
+    try:
+        with DatabaseConnection(on_commit=audience_cache.invalidate) as conn:
             c = conn.cursor()
             c.execute("""
                 UPDATE users 
@@ -0,0 +1,297 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+from telethon.errors import (
+    FilePartMissingError,
+    FilePartsInvalidError,
+    FileReferenceExpiredError,
+    FloodWaitError,
+    MediaEmptyError
+)
+from async_database import db
+from config_store import get_config
+from database import complete_outbox, fetch_outbox
+from rate_limiter import TokenBucket
+import media_store
+
+# Значения по умолчанию для config['delivery']. Telegram разрешает боту около 30 сообщений в секунду
+# в сумме и не больше одного сообщения в секунду в один чат
+DEFAULT_SETTINGS = {'messages_per_second': 30, 'chat_interval': 1, 'max_concurrency': 20, 'max_retries': 3}
+
+# Значения по умолчанию для очереди рассылки в config['delivery']: размер выборки заданий, интервал записи
+# результатов (с), число попыток на получателя и пауза перед первой повторной попыткой (с)
+OUTBOX_SETTINGS = {'outbox_batch_size': 500, 'outbox_flush_interval': 1, 'max_attempts': 5, 'retry_delay': 60}
+
+# Ошибки, после которых сохраненная ссылка на файл больше не годится и файл нужно загрузить заново
+STALE_MEDIA_ERRORS = (FileReferenceExpiredError, FilePartMissingError, FilePartsInvalidError, MediaEmptyError)
+
+SendFunc = Callable[[], Awaitable]
+
+class DeliveryScheduler:
+    # У каждого чата своя очередь (полоса): сообщения в чат уходят по порядку и не чаще chat_interval,
+    # а FloodWaitError приостанавливает только полосу этого чата. Суммарную частоту держит общий token bucket
+    def __init__(self, messages_per_second: float = 30, chat_interval: float = 1,
+                 max_concurrency: int = 20, max_retries: int = 3):
+        # Без накопленного запаса: лимит Telegram считается по секундам, и всплеск в начале рассылки его превысит
+        self.bucket = TokenBucket(messages_per_second, capacity=1)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.lanes: Dict[int, Deque[list]] = {}
+        self.ready_at: Dict[int, float] = {}
+        self.queued = 0
+        self.busy_since: Optional[float] = None
+        self.busy_sent = 0
+        self.stats = {'sent': 0, 'failed': 0, 'flood_waits': 0, 'max_queue': 0}
+
+    def submit(self, chat_id: int, send: SendFunc) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self.queued == 0:
+            self.busy_since = time.monotonic()
+            self.busy_sent = 0
+        lane = self.lanes.get(chat_id)
+        if lane is None:
+            lane = self.lanes[chat_id] = deque()
+            asyncio.ensure_future(self._run_lane(chat_id, lane))
+        # Задание: функция отправки, future с результатом и число попыток после FloodWait
+        lane.append([send, future, 0])
+        self.queued += 1
+        self.stats['max_queue'] = max(self.stats['max_queue'], self.queued)
+        return future
+
+    async def _run_lane(self, chat_id: int, lane: Deque[list]):
+        try:
+            while lane:
+                job = lane[0]
+                if job[1].done():
+                    # Задание отменено до отправки (например, рассылка прервана по таймауту)
+                    lane.popleft()
+                    self.queued -= 1
+                    continue
+                delay = self.ready_at.get(chat_id, 0) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                result = await self._send(chat_id, job)
+                if result is None:
+                    continue
+                lane.popleft()
+                self.queued -= 1
+                if not job[1].done():
+                    job[1].set_result(result)
+        finally:
+            for job in lane:
+                self.queued -= 1
+                if not job[1].done():
+                    job[1].cancel()
+            del self.lanes[chat_id]
+
+    async def _send(self, chat_id: int, job: list) -> Optional[bool]:
+        async with self.semaphore:
+            await self.bucket.acquire()
+            if job[1].done():
+                # Задание отменили, пока оно ждало своей очереди
+                return False
+            try:
+                await job[0]()
+            except FloodWaitError as e:
+                self.stats['flood_waits'] += 1
+                self.ready_at[chat_id] = time.monotonic() + e.seconds
+                job[2] += 1
+                if job[2] > self.max_retries:
+                    print(f"❌ Сообщение пользователю {chat_id} не отправлено: превышено число попыток после FloodWait")
+                    self.stats['failed'] += 1
+                    return False
+                print(f"⏳ FloodWait для чата {chat_id}: полоса приостановлена на {e.seconds} с")
+                return None
+            except Exception as e:
+                print(f"❌ Ошибка при отправке сообщения пользователю {chat_id}: {str(e)}")
+                self.stats['failed'] += 1
+                return False
+        self.ready_at[chat_id] = time.monotonic() + self.chat_interval
+        self.stats['sent'] += 1
+        self.busy_sent += 1
+        return True
+
+    def throughput(self) -> float:
+        if self.busy_since is None:
+            return 0.0
+        elapsed = time.monotonic() - self.busy_since
+        return self.busy_sent / elapsed if elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return (f"отправлено {self.stats['sent']}, ошибок {self.stats['failed']}, "
+                f"FloodWait {self.stats['flood_waits']}, в очереди {self.queued} "
+                f"(максимум {self.stats['max_queue']}), {self.throughput():.1f} сообщений/с")
+
+class MediaUploads:
+    # Файл рассылки загружается в Telegram один раз на всех получателей: первая загрузка идет через
+    # upload_file, а после первой успешной отправки вместо загруженного файла хранится media из отправленного
+    # сообщения, которое Telegram повторно не обрабатывает. Одновременные отправки ждут одну загрузку
+    def __init__(self, max_entries: int = 100):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[str, Any]' = OrderedDict()
+        self.sent_media = set()
+        self.in_progress: Dict[str, asyncio.Future] = {}
+        self.stats = {'uploads': 0, 'reused': 0}
+
+    def _put(self, path: str, file: Any):
+        self.entries[path] = file
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.max_entries:
+            old_path, _ = self.entries.popitem(last=False)
+            self.sent_media.discard(old_path)
+
+    def forget(self, path: str):
+        self.entries.pop(path, None)
+        self.sent_media.discard(path)
+
+    async def get(self, client, path: str) -> Any:
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            self.stats['reused'] += 1
+            return self.entries[path]
+        if path in self.in_progress:
+            self.stats['reused'] += 1
+            return await asyncio.shield(self.in_progress[path])
+
+        # Загрузка идет отдельной задачей, чтобы отмена одного получателя не прерывала ее для остальных
+        future = asyncio.ensure_future(client.upload_file(path))
+        self.in_progress[path] = future
+        try:
+            uploaded = await asyncio.shield(future)
+        finally:
+            if self.in_progress.get(path) is future:
+                del self.in_progress[path]
+        self.stats['uploads'] += 1
+        self._put(path, uploaded)
+        return uploaded
+
+    def remember(self, path: str, message: Any):
+        media = getattr(message, 'media', None)
+        if media is not None and path in self.entries and path not in self.sent_media:
+            self._put(path, media)
+            self.sent_media.add(path)
+
+    async def send(self, client, chat_id: int, path: str, **kwargs) -> Any:
+        if not get_config().get('delivery', {}).get('upload_media_once', True):
+            return await client.send_file(chat_id, path, **kwargs)
+        file = await self.get(client, path)
+        try:
+            message = await client.send_file(chat_id, file, **kwargs)
+        except STALE_MEDIA_ERRORS as e:
+            print(f"⚠️ Загруженный файл {path} больше недоступен в Telegram ({str(e)}), загружаем заново")
+            if self.entries.get(path) is file:
+                self.forget(path)
+            file = await self.get(client, path)
+            message = await client.send_file(chat_id, file, **kwargs)
+        self.remember(path, message)
+        return message
+
+    def report(self) -> str:
+        return f"загрузок медиафайлов {self.stats['uploads']}, повторных использований {self.stats['reused']}"
+
+media_uploads = MediaUploads()
+
+class OutboxDispatcher:
+    # Задания из таблицы outbox выбираются пачками в порядке постановки и отправляются через DeliveryScheduler.
+    # Результаты записываются в базу по мере готовности раз в outbox_flush_interval, поэтому после
+    # перезапуска повторно уходят только сообщения, отправленные за последние секунды перед остановкой
+    def __init__(self):
+        self.running = False
+        self.requested = False
+        self.missing_media = set()
+        self.stats = {'sent': 0, 'failed': 0}
+
+    async def dispatch(self, client):
+        # Повторный вызов во время рассылки только просит пройти очередь еще раз после текущей пачки
+        self.requested = True
+        if self.running:
+            return
+        self.running = True
+        try:
+            while self.requested:
+                self.requested = False
+                while await self._drain_batch(client):
+                    pass
+            # Медиафайлы сообщений, разосланных всем получателям, больше не нужны очереди
+            removed = await db.call(media_store.release_delivered)
+            if removed:
+                print(f"🗑 Удалено {removed} медиафайлов разосланных сообщений")
+        finally:
+            self.running = False
+
+    async def _send_job(self, client, job: Dict):
+        media_path = job['media_path']
+        if media_path and not os.path.exists(media_path):
+            # Очередь держит ссылку на файл, так что его удалили с диска вручную
+            if job['message_id'] not in self.missing_media:
+                self.missing_media.add(job['message_id'])
+                print(f"⚠️ Медиафайл {media_path} сообщения {job['message_id']} не найден, отправляем только текст")
+            media_path = None
+        if media_path:
+            # Подпись к медиафайлу в Telegram ограничена 1024 символами
+            await media_uploads.send(client, job['user_id'], media_path, caption=job['text'][:1024])
+        else:
+            await client.send_message(job['user_id'], job['text'])
+
+    async def _drain_batch(self, client) -> int:
+        delivery_config = get_config().get('delivery', {})
+        settings = {key: delivery_config.get(key, default) for key, default in OUTBOX_SETTINGS.items()}
+        jobs = await db.call(fetch_outbox, settings['outbox_batch_size'])
+        if not jobs:
+            return 0
+
+        scheduler = get_scheduler()
+        pending = {
+            scheduler.submit(job['user_id'], lambda job=job: self._send_job(client, job)): job
+            for job in jobs
+        }
+        sent = failed = 0
+        unsaved = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=settings['outbox_flush_interval'])
+                for future in done:
+                    job = pending.pop(future)
+                    delivered = not future.cancelled() and future.result() is True
+                    unsaved.append((job['message_id'], job['user_id'], job['attempts'], delivered))
+                    sent += delivered
+                    failed += not delivered
+                # Если запись не удалась, результаты попадут в следующую
+                if unsaved and await db.call(complete_outbox, unsaved, settings['max_attempts'], settings['retry_delay']):
+                    unsaved = []
+        except asyncio.CancelledError:
+            # Рассылку прервали: еще не начатые задания остаются в очереди, готовые результаты записываются.
+            # Повторно уйти могут только сообщения, которые отправлялись в момент отмены
+            for future, job in pending.items():
+                if future.done() and not future.cancelled():
+                    unsaved.append((job['message_id'], job['user_id'], job['attempts'], future.result() is True))
+                else:
+                    future.cancel()
+            if unsaved:
+                await asyncio.shield(db.call(complete_outbox, unsaved, settings['max_attempts'], settings['retry_delay']))
+            raise
+        if unsaved:
+            # Без записи результатов те же задания выбирались бы снова, очередь пройдем в следующий раз
+            self.requested = False
+            return 0
+        self.stats['sent'] += sent
+        self.stats['failed'] += failed
+        print(f"📬 Очередь рассылки: доставлено {sent} из {len(jobs)} заданий ({scheduler.report()})")
+        return len(jobs)
+
+outbox = OutboxDispatcher()
+
+_scheduler: Optional[DeliveryScheduler] = None
+_settings: Dict = {}
+
+def get_scheduler() -> DeliveryScheduler:
+    global _scheduler, _settings
+    delivery_config = get_config().get('delivery', {})
+    settings = {key: delivery_config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+    if _scheduler is None or (settings != _settings and _scheduler.queued == 0):
+        _scheduler = DeliveryScheduler(**settings)
+        _settings = settings
+    return _scheduler
@@ -0,0 +1,71 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple, Union
+import aiohttp
+from rate_limiter import TokenBucket
+from http_cache import get_http_cache
+
+API_URL = "https://api.hh.ru"
+
+# Статусы, после которых запрос можно повторить: превышение лимита запросов и ошибки сервера
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class HHClient:
+    def __init__(self, headers: Dict[str, str], requests_per_second: float = 5, timeout: float = 15,
+                 max_connections: int = 10):
+        self.headers = headers
+        self.limiter = TokenBucket(requests_per_second)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_connections = max_connections
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Одна сессия на клиента: соединения с api.hh.ru переиспользуются между запросами и циклами
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, headers=self.headers)
+        return self.session
+
+    async def get(self, path: str, params: Optional[Union[Dict, List[Tuple[str, str]]]] = None,
+                  max_retries: int = 3) -> Optional[Dict]:
+        url = API_URL + path
+        cache = get_http_cache()
+        key = entry = None
+        if cache.is_cacheable(url):
+            key = cache.make_key(url, params)
+            entry = cache.load(key)
+            if entry and cache.is_fresh(entry):
+                return cache.hit(key, entry)
+        # Устаревшая запись проверяется условным запросом: при ответе 304 тело не загружается заново
+        headers = cache.conditional_headers(entry)
+
+        for attempt in range(max_retries):
+            await self.limiter.acquire()
+            try:
+                async with self.get_session().get(url, params=params, headers=headers) as response:
+                    if response.status == 304 and entry:
+                        return cache.revalidated(key, url, entry)
+                    if response.status == 200:
+                        body = await response.json(content_type=None)
+                        if key:
+                            cache.store(key, url, body, response.headers)
+                        return body
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"⚠️ Попытка {attempt + 1}/{max_retries} запроса {path} не удалась: {str(e) or e.__class__.__name__}")
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(2 ** attempt)
+                continue
+
+            if status not in RETRY_STATUSES or attempt == max_retries - 1:
+                print(f"❌ Ошибка получения данных {path}: {status}")
+                return None
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+            print(f"⚠️ HH.ru ответил {status} на запрос {path}, повтор через {delay:g} с")
+            await asyncio.sleep(delay)
+        return None
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
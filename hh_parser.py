@@ -1,22 +1,20 @@
-import requests
 from bs4 import BeautifulSoup
 import json
 from datetime import datetime
-import time
+import asyncio
 import re
 import os
-from typing import Optional, List, Dict
-import sqlite3
-
-def load_config():
-    config_file = 'config.json'
-    if not os.path.exists(config_file):
-        config_file = 'config.example.json'
-        print(f"⚠️ Файл config.json не найден, используем {config_file}")
-        print("⚠️ Создайте файл config.json на основе примера и заполните его вашими данными")
-    
-    with open(config_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+from typing import Optional, List, Dict, Tuple
+from keyword_filter import check
+from async_database import db
+from database import is_message_sent
+from config_store import get_config, get_source_filter
+from hh_client import HHClient
+from http_cache import get_http_cache
+from json_store import load_json, save_json
+
+# Профиль поиска, если в config['sources']['hh']['profiles'] ничего не задано
+DEFAULT_PROFILE = {'name': 'default', 'text': 'видеомонтажер', 'area': '1'}
 
 class HHParser:
     def __init__(self):
@@ -24,52 +22,47 @@ class HHParser:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Accept': 'application/json'
         }
-        self.base_url = "https://api.hh.ru/vacancies"
-        self.params = {
-            'text': 'видеомонтажер',
-            'area': '1',
-            'per_page': 5,
-            'order_by': 'publication_time',
-            'period': 1
-        }
+        self.client: Optional[HHClient] = None
+        self.client_settings = None
         self.data_folder = "hh"
         self.messages_folder = os.path.join(self.data_folder, "messages")
         os.makedirs(self.messages_folder, exist_ok=True)
-        self.max_pages = 2
-        self.max_vacancies = 5
+        self.state_path = os.path.join(self.data_folder, "state.json")
+        self.first_run_vacancies = 5
+        # Сколько раз запрашивать подробности вакансии, которые не удалось получить
+        self.max_detail_attempts = 3
 
-    async def get_saved_messages(self) -> set:
-        saved_messages = set()
-        try:
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute('SELECT message_id FROM sent_messages WHERE source = "hh"')
-            for row in c.fetchall():
-                vacancy_id = row[0].split('_')[-1]
-                saved_messages.add(vacancy_id)
-            conn.close()
-            print(f"✅ Загружено {len(saved_messages)} сохраненных вакансий из базы данных")
-        except Exception as e:
-            print(f"❌ Ошибка при чтении сохраненных вакансий из базы данных: {str(e)}")
-        return saved_messages
+    async def configure(self):
+        # Настройки читаются в начале каждого цикла: парсер живет между циклами, а config.json может измениться
+        hh_config = get_config()['sources'].get('hh', {})
+        client_settings = (hh_config.get('requests_per_second', 5), hh_config.get('request_timeout', 15))
+        if client_settings != self.client_settings:
+            if self.client is not None:
+                await self.client.close()
+            self.client = HHClient(self.headers, requests_per_second=client_settings[0], timeout=client_settings[1])
+            self.client_settings = client_settings
+        self.profiles = hh_config.get('profiles') or [DEFAULT_PROFILE]
+        # HH отдает не больше 2000 вакансий на один поиск
+        self.per_page = min(hh_config.get('per_page', 100), 100)
+        self.max_pages = min(hh_config.get('max_pages', 20), 2000 // self.per_page)
+        self.max_vacancies = hh_config.get('max_vacancies', 100)
 
     def should_save_message(self, vacancy: Dict) -> bool:
         if not vacancy.get('name') and not vacancy.get('description'):
             return False
-        text = f"{vacancy.get('name', '')} {vacancy.get('description', '')}".lower()
-        config = load_config()
-        include_filters = config.get('sources', {}).get('hh', {}).get('include_filters', [])
-        exclude_filters = config.get('sources', {}).get('hh', {}).get('exclude_filters', [])
-        for word in exclude_filters:
-            if word.lower() in text:
-                print(f"❌ Вакансия содержит исключающее слово '{word}', пропускаем")
-                return False
-        if include_filters:
-            for word in include_filters:
-                if word.lower() in text:
-                    print(f"✅ Найдено совпадение по слову '{word}'")
-                    return True
-            print("❌ Не найдено совпадений по словам для включения, пропускаем")
+        text = f"{vacancy.get('name', '')} {vacancy.get('description', '')}"
+        return check(get_source_filter('hh'), text, "Вакансия")
+
+    def prefilter(self, vacancy: Dict) -> bool:
+        # Первый этап по данным из выдачи: название и фрагменты описания (snippet).
+        # Отсеиваются только вакансии с исключающими словами, слова для совпадения
+        # могут найтись в полном описании, поэтому по ним решает второй этап
+        snippet = vacancy.get('snippet') or {}
+        text = " ".join(part for part in [vacancy.get('name'), snippet.get('requirement'), snippet.get('responsibility')] if part)
+        text = re.sub(r'<[^>]+>', '', text)
+        result = get_source_filter('hh').match(text)
+        if result.exclude_hits:
+            print(f"❌ Вакансия {vacancy['id']} содержит исключающее слово '{result.exclude_hits[0]}', пропускаем без загрузки")
             return False
         return True
 
@@ -105,60 +98,192 @@ class HHParser:
             return f"до {to_salary} {currency}"
         return "Зарплата не указана"
 
+    def get_search_params(self, profile: Dict, state: Dict) -> List[Tuple[str, str]]:
+        # Все поля профиля, кроме служебных, передаются в поиск HH как есть; списки — повторяющимися параметрами
+        params = [('order_by', 'publication_time')]
+        for key, value in profile.items():
+            if key in ('name', 'active'):
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                params.append((key, str(item)))
+        if state.get('date_from'):
+            # Ищем только вакансии, опубликованные не раньше самой новой из уже просмотренных
+            params.append(('date_from', state['date_from']))
+            params.append(('per_page', str(self.per_page)))
+        else:
+            # Поиск запускается впервые: берем только последние вакансии за сутки
+            params.append(('period', '1'))
+            params.append(('per_page', str(self.first_run_vacancies)))
+        return params
+
+    def load_state(self) -> Dict:
+        state = load_json(self.state_path, {})
+        if 'date_from' in state:
+            # Состояние в прежнем формате, до появления профилей поиска
+            state = {'profiles': {DEFAULT_PROFILE['name']: state}}
+        state.setdefault('profiles', {})
+        return state
+
+    async def get_sent_ids(self, vacancy_ids: List[str]) -> set:
+        # Проверка всей пачки идет одним обращением к потоку базы, чтобы SQLite не блокировал цикл событий
+        results = await db.call_many([(is_message_sent, 'hh', 'hh', vacancy_id) for vacancy_id in vacancy_ids])
+        return {vacancy_id for vacancy_id, sent in zip(vacancy_ids, results) if sent}
+
+    async def fetch_details(self, name: str, vacancy_ids: List[str], attempts: Dict[str, int], claimed: set,
+                            requests: Dict[str, asyncio.Future], messages_data: List[Dict], failed: Dict[str, int]) -> bool:
+        # Возвращает True, если достигнут лимит новых вакансий за цикл.
+        # Вакансию, найденную несколькими профилями, запрашивает первый из них, остальные ждут тот же запрос
+        for vacancy_id in vacancy_ids:
+            if vacancy_id not in requests:
+                requests[vacancy_id] = asyncio.ensure_future(self.client.get(f"/vacancies/{vacancy_id}"))
+        details = await asyncio.gather(
+            *(asyncio.shield(requests[vacancy_id]) for vacancy_id in vacancy_ids),
+            return_exceptions=True
+        )
+        for position, (vacancy_id, full_vacancy) in enumerate(zip(vacancy_ids, details)):
+            if len(messages_data) >= self.max_vacancies:
+                print(f"\n✋ Достигнут лимит в {self.max_vacancies} новых вакансий, остальные будут получены в следующем цикле")
+                for rest_id in vacancy_ids[position:]:
+                    failed.setdefault(rest_id, attempts.get(rest_id, 0))
+                return True
+            if isinstance(full_vacancy, Exception) or full_vacancy is None:
+                # Отметка date_from может уйти дальше этой вакансии, поэтому она запоминается для повторного запроса
+                failed[vacancy_id] = attempts.get(vacancy_id, 0) + 1
+                if isinstance(full_vacancy, Exception):
+                    print(f"❌ Ошибка при обработке вакансии {vacancy_id}: {str(full_vacancy)}")
+                continue
+            if vacancy_id in claimed:
+                # Вакансию уже сохранил другой профиль в этом цикле
+                continue
+            try:
+                if not self.should_save_message(full_vacancy):
+                    continue
+                vacancy_data = self.parse_vacancy(full_vacancy)
+                if vacancy_data:
+                    claimed.add(vacancy_id)
+                    messages_data.append(vacancy_data)
+                    print(f"✅ [{name}] Получена новая вакансия: {vacancy_data['title']} ({len(messages_data)}/{self.max_vacancies})")
+            except Exception as e:
+                print(f"❌ Ошибка при обработке вакансии {vacancy_id}: {str(e)}")
+                continue
+        return False
+
+    async def run_profile(self, profile: Dict, state: Dict, claimed: set, requests: Dict[str, asyncio.Future],
+                          messages_data: List[Dict], stats: Dict[str, set]) -> Dict:
+        name = profile['name']
+        base_params = self.get_search_params(profile, state)
+        max_pages = self.max_pages if state.get('date_from') else 1
+        # date_from включает границу, поэтому вакансии с прошлой отметки запоминаются и пропускаются
+        seen_at_watermark = set(state.get('seen_ids', []))
+        newest = None
+        newest_ids = set()
+        truncated = False
+        # Вакансии, подробности которых не удалось получить: id -> число попыток
+        attempts = state.get('retry_ids', {})
+        failed = {}
+        sent_ids = await self.get_sent_ids(list(attempts))
+        retry_ids = [vacancy_id for vacancy_id in attempts if vacancy_id not in claimed and vacancy_id not in sent_ids]
+        if retry_ids:
+            print(f"\n🔁 [{name}] Повторно запрашиваем подробности {len(retry_ids)} вакансий")
+            truncated = await self.fetch_details(name, retry_ids, attempts, claimed, requests, messages_data, failed)
+        page = 0
+        while page < max_pages and not truncated:
+            print(f"\n🔍 [{name}] Получаем вакансии с HH.ru (страница {page + 1})...")
+            data = await self.client.get('/vacancies', params=base_params + [('page', str(page))])
+            if data is None:
+                truncated = True
+                break
+            vacancies = data.get('items', [])
+            if not vacancies:
+                print(f"ℹ️ [{name}] Новых вакансий не найдено")
+                break
+            print(f"📥 [{name}] Получено {len(vacancies)} вакансий с HH.ru")
+            new_ids = []
+            sent_ids = await self.get_sent_ids([str(vacancy['id']) for vacancy in vacancies])
+            for vacancy in vacancies:
+                vacancy_id = str(vacancy['id'])
+                published_at = datetime.strptime(vacancy['published_at'], "%Y-%m-%dT%H:%M:%S%z")
+                if newest is None or published_at > newest[0]:
+                    newest = (published_at, vacancy['published_at'])
+                    newest_ids = {vacancy_id}
+                elif published_at == newest[0]:
+                    newest_ids.add(vacancy_id)
+                if vacancy_id in seen_at_watermark or vacancy_id in sent_ids:
+                    print(f"⏩ Вакансия {vacancy_id} уже обработана ранее, пропускаем")
+                    continue
+                if vacancy_id in claimed:
+                    # Вакансию уже сохранил другой профиль в этом цикле
+                    continue
+                if vacancy_id in stats['prefiltered']:
+                    continue
+                if vacancy_id not in stats['candidates']:
+                    # Фильтр у всех профилей общий, поэтому вакансия проверяется один раз за цикл
+                    stats['candidates'].add(vacancy_id)
+                    if not self.prefilter(vacancy):
+                        stats['prefiltered'].add(vacancy_id)
+                        continue
+                new_ids.append(vacancy_id)
+
+            # Подробности по новым вакансиям страницы запрашиваются параллельно, частоту ограничивает HHClient
+            if new_ids:
+                print(f"\n🔍 [{name}] Загружаем подробности {len(new_ids)} новых вакансий")
+                truncated = await self.fetch_details(name, new_ids, attempts, claimed, requests, messages_data, failed)
+            if truncated:
+                break
+            page += 1
+            if page >= data.get('pages', 1):
+                break
+            if page >= max_pages and state.get('date_from'):
+                print(f"\n✋ [{name}] Достигнут лимит в {max_pages} страниц, остальные вакансии будут получены в следующем цикле")
+                truncated = True
+
+        new_state = dict(state)
+        # Отметка сдвигается, только если все новые вакансии просмотрены, иначе остаток заберет следующий цикл
+        if newest and (not truncated or not state.get('date_from')):
+            if newest[1] == state.get('date_from'):
+                newest_ids |= seen_at_watermark
+            new_state.update({'date_from': newest[1], 'seen_ids': sorted(newest_ids)})
+        # Невыбранные в этом цикле повторы остаются в списке
+        leftover = [vacancy_id for vacancy_id in attempts if vacancy_id not in retry_ids and vacancy_id not in failed]
+        sent_ids = await self.get_sent_ids(leftover)
+        for vacancy_id in leftover:
+            if vacancy_id not in sent_ids:
+                failed[vacancy_id] = attempts[vacancy_id]
+        for vacancy_id, count in failed.items():
+            if count >= self.max_detail_attempts:
+                print(f"⚠️ [{name}] Не удалось получить подробности вакансии {vacancy_id} за {count} попыток, пропускаем")
+        new_state['retry_ids'] = {vacancy_id: count for vacancy_id, count in failed.items() if count < self.max_detail_attempts}
+        return new_state
+
     async def run(self) -> bool:
+        await self.configure()
         messages_data = []
-        saved_messages = await self.get_saved_messages()
-        consecutive_old_vacancies = 0
-        max_old_vacancies = 3
-        page = 0
+        state = self.load_state()
+        profiles = [profile for profile in self.profiles if profile.get('active', True)]
+        # Общие для всех профилей: вакансия, найденная несколькими профилями, сохраняется один раз.
+        # Вакансия считается занятой только после сохранения, отклоненную или не загруженную проверят другие профили
+        claimed = set()
+        # Запросы подробностей по id вакансии и id вакансий, прошедших через предварительный фильтр
+        requests = {}
+        stats = {'candidates': set(), 'prefiltered': set()}
         try:
-            while page < self.max_pages:
-                print(f"\n🔍 Получаем вакансии с HH.ru (страница {page + 1} из {self.max_pages})...")
-                self.params['page'] = page
-                response = requests.get(self.base_url, params=self.params, headers=self.headers)
-                if response.status_code != 200:
-                    print(f"❌ Ошибка получения данных: {response.status_code}")
-                    break
-                data = response.json()
-                vacancies = data.get('items', [])
-                if not vacancies:
-                    print("ℹ️ Больше вакансий не найдено")
-                    break
-                print(f"📥 Получено {len(vacancies)} вакансий с HH.ru")
-                found_new_on_page = False
-                for vacancy in vacancies:
-                    if len(messages_data) >= self.max_vacancies:
-                        print(f"\n✋ Достигнут лимит в {self.max_vacancies} новых вакансий")
-                        break
-                    try:
-                        vacancy_id = str(vacancy['id'])
-                        if vacancy_id in saved_messages:
-                            print(f"⏩ Вакансия {vacancy_id} уже обработана ранее, пропускаем")
-                            consecutive_old_vacancies += 1
-                            continue
-                        consecutive_old_vacancies = 0
-                        found_new_on_page = True
-                        print(f"\n🔍 Обрабатываем новую вакансию {vacancy_id}")
-                        vacancy_response = requests.get(f"{self.base_url}/{vacancy_id}", headers=self.headers)
-                        if vacancy_response.status_code == 200:
-                            full_vacancy = vacancy_response.json()
-                            if not self.should_save_message(full_vacancy):
-                                continue
-                            vacancy_data = self.parse_vacancy(full_vacancy)
-                            if vacancy_data:
-                                messages_data.append(vacancy_data)
-                                print(f"✅ Получена новая вакансия: {vacancy_data['title']} ({len(messages_data)}/{self.max_vacancies})")
-                    except Exception as e:
-                        print(f"❌ Ошибка при обработке вакансии {vacancy.get('id')}: {str(e)}")
-                        continue
-                    time.sleep(1)
-                if len(messages_data) >= self.max_vacancies:
-                    break
-                if not found_new_on_page and consecutive_old_vacancies >= max_old_vacancies:
-                    print(f"\n🔄 Найдено {consecutive_old_vacancies} последовательных старых вакансий. Завершаем поиск.")
-                    break
-                page += 1
-                time.sleep(2)
+            results = await asyncio.gather(
+                *(self.run_profile(profile, state['profiles'].get(profile['name'], {}), claimed, requests, messages_data, stats)
+                  for profile in profiles),
+                return_exceptions=True
+            )
+            for profile, result in zip(profiles, results):
+                if isinstance(result, Exception):
+                    print(f"\n❌ Ошибка в профиле поиска {profile['name']}: {str(result)}")
+                else:
+                    state['profiles'][profile['name']] = result
+            save_json(self.state_path, state)
+
+            if stats['candidates']:
+                print(f"\n📊 Предварительный фильтр: отсеяно {len(stats['prefiltered'])} из {len(stats['candidates'])} новых вакансий, "
+                      f"сэкономлено {len(stats['prefiltered'])} запросов подробностей")
+            print(f"📊 HTTP-кэш: {get_http_cache().report()}")
+
             if messages_data:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 output_file = os.path.join(self.messages_folder, f'messages_{timestamp}.json')
@@ -172,16 +297,25 @@ class HHParser:
         except Exception as e:
             print(f"\n❌ Произошла ошибка: {str(e)}")
             return False
+        finally:
+            # Запросы, которые никто не ждет после прерывания цикла
+            for request in requests.values():
+                request.cancel()
+
+# Экземпляр парсера живет между циклами, когда парсер запущен внутри бота
+parser = None
 
 async def main():
+    global parser
     try:
-        config = load_config()
+        config = get_config()
         if not config.get('sources', {}).get('hh', {}).get('enabled', False):
             print("❌ Источник HH отключен в конфигурации")
             return False
-        print("\n🔄 Инициализация HH парсера...")
-        parser = HHParser()
-        print("✅ HH парсер инициализирован")
+        if parser is None:
+            print("\n🔄 Инициализация HH парсера...")
+            parser = HHParser()
+            print("✅ HH парсер инициализирован")
         success = await parser.run()
         if success:
             print("\n✅ HH парсер успешно завершил работу")
@@ -192,7 +326,19 @@ async def main():
         print(f"\n❌ Критическая ошибка в HH парсере: {str(e)}")
         return False
 
+async def close():
+    global parser
+    if parser is not None:
+        if parser.client is not None:
+            await parser.client.close()
+        parser = None
+
+async def run_once():
+    try:
+        return await main()
+    finally:
+        await close()
+
 if __name__ == '__main__':
-    import asyncio
-    success = asyncio.run(main())
+    success = asyncio.run(run_once())
     exit(0 if success else 1)
\ No newline at end of file
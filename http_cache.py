@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from config_store import get_config
+
+# Значения по умолчанию для config['http_cache']. Время жизни задается по префиксу адреса,
+# ответы адресов без подходящего префикса не кэшируются
+DEFAULT_SETTINGS = {
+    'folder': 'cache/http',
+    'max_size_mb': 100,
+    'ttl': {
+        'https://api.hh.ru/vacancies/': 24 * 3600,
+        'https://api.vk.com/method/groups.getById': 7 * 24 * 3600
+    }
+}
+
+# Параметры, которые не должны попадать в ключ и на диск
+PRIVATE_PARAMS = {'access_token'}
+
+Params = Optional[Union[Dict, List[Tuple[str, str]]]]
+
+class HTTPCache:
+    def __init__(self, folder: str, max_size_mb: float = 100, ttl: Optional[Dict[str, float]] = None):
+        self.folder = folder
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        # Более длинный префикс важнее: так /vacancies/{id} не путается с /vacancies
+        self.ttl = sorted((ttl or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.size: Optional[int] = None
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+    def get_ttl(self, url: str) -> float:
+        for prefix, ttl in self.ttl:
+            if url.startswith(prefix):
+                return ttl
+        return 0
+
+    def is_cacheable(self, url: str) -> bool:
+        return self.get_ttl(url) > 0
+
+    def make_key(self, url: str, params: Params = None) -> str:
+        items = params.items() if isinstance(params, dict) else (params or [])
+        public = sorted((str(key), str(value)) for key, value in items if key not in PRIVATE_PARAMS)
+        return hashlib.sha256(json.dumps([url, public], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def load(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self.get_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: Dict) -> bool:
+        return time.time() < entry.get('expires_at', 0)
+
+    def conditional_headers(self, entry: Optional[Dict]) -> Dict[str, str]:
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, key: str, entry: Dict):
+        self.stats['hits'] += 1
+        # Время изменения файла служит отметкой последнего использования при вытеснении
+        self._touch(key)
+        return entry['body']
+
+    def revalidated(self, key: str, url: str, entry: Dict):
+        self.stats['revalidated'] += 1
+        entry['expires_at'] = time.time() + self.get_ttl(url)
+        self._write(key, entry)
+        return entry['body']
+
+    def store(self, key: str, url: str, body, headers=None):
+        self.stats['misses'] += 1
+        headers = headers or {}
+        self._write(key, {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'expires_at': time.time() + self.get_ttl(url),
+            'body': body
+        })
+
+    def hit_rate(self) -> float:
+        total = sum(self.stats.values())
+        return (self.stats['hits'] + self.stats['revalidated']) / total if total else 0.0
+
+    def report(self) -> str:
+        return (f"{self.stats['hits']} попаданий, {self.stats['revalidated']} подтверждено ответом 304, "
+                f"{self.stats['misses']} промахов, доля попаданий {self.hit_rate():.0%}")
+
+    def _touch(self, key: str):
+        try:
+            os.utime(self.get_path(key))
+        except OSError:
+            pass
+
+    def _write(self, key: str, entry: Dict):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        if self.size is None:
+            self.size = self._scan_size()
+        else:
+            self.size += os.path.getsize(path) - old_size
+        if self.size > self.max_size:
+            self._evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        for subfolder in os.scandir(self.folder):
+            if not subfolder.is_dir():
+                continue
+            for entry in os.scandir(subfolder.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Удаляем давно не использованные записи, пока кэш не займет 90% от лимита
+        entries = sorted(self._entries())
+        self.size = sum(size for _, size, _ in entries)
+        target = int(self.max_size * 0.9)
+        removed = 0
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"🧹 HTTP-кэш: удалено {removed} старых записей")
+
+# Один кэш на процесс, его общий для всех клиентов размер ограничивается max_size_mb
+_cache: Optional[HTTPCache] = None
+_settings: Dict = {}
+
+def get_http_cache() -> HTTPCache:
+    global _cache, _settings
+    cache_config = get_config().get('http_cache', {})
+    settings = {key: cache_config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+    if _cache is None or settings != _settings:
+        _cache = HTTPCache(**settings)
+        _settings = settings
+    return _cache
@@ -0,0 +1,19 @@
+import json
+import os
+
+def load_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Не удалось прочитать файл {path}: {str(e)}")
+        return default
+
+def save_json(path, data):
+    # Пишем во временный файл и подменяем, чтобы прерванная запись не портила состояние
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
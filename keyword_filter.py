@@ -0,0 +1,74 @@
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+class FilterResult(NamedTuple):
+    accepted: bool
+    include_hits: List[str]
+    exclude_hits: List[str]
+
+class KeywordFilter:
+    def __init__(self, include_filters: Sequence[str], exclude_filters: Sequence[str]):
+        self.include_filters = list(include_filters)
+        self.exclude_filters = list(exclude_filters)
+
+        # Слова для совпадения и исключения проверяются вместе, каждое уникальное слово один раз.
+        # Короткие слова идут первыми: если слово не найдено, то и любое содержащее его слово
+        # (например, "монтажер" для "монтаж") не может быть найдено, и его проверка пропускается.
+        patterns = sorted({word.lower() for word in self.include_filters + self.exclude_filters}, key=len)
+        index = {pattern: position for position, pattern in enumerate(patterns)}
+        parents = [self._find_parent(patterns, position) for position in range(len(patterns))]
+        self._size = len(patterns)
+        self._roots: Tuple[Tuple[int, str], ...] = tuple(
+            (position, pattern) for position, pattern in enumerate(patterns) if parents[position] is None
+        )
+        self._children: Tuple[Tuple[int, str, int], ...] = tuple(
+            (position, pattern, parents[position]) for position, pattern in enumerate(patterns)
+            if parents[position] is not None
+        )
+        self._include = tuple((word, index[word.lower()]) for word in self.include_filters)
+        self._exclude = tuple((word, index[word.lower()]) for word in self.exclude_filters)
+
+    @staticmethod
+    def _find_parent(patterns: List[str], position: int) -> Optional[int]:
+        pattern = patterns[position]
+        for candidate in range(position - 1, -1, -1):
+            if patterns[candidate] in pattern:
+                return candidate
+        return None
+
+    def match(self, text: str) -> FilterResult:
+        text = text.lower()
+        found = [False] * self._size
+        for position, pattern in self._roots:
+            if pattern in text:
+                found[position] = True
+        for position, pattern, parent in self._children:
+            if found[parent] and pattern in text:
+                found[position] = True
+
+        include_hits = [word for word, position in self._include if found[position]]
+        exclude_hits = [word for word, position in self._exclude if found[position]]
+        accepted = not exclude_hits and (not self._include or bool(include_hits))
+        return FilterResult(accepted, include_hits, exclude_hits)
+
+@lru_cache(maxsize=1024)
+def _compile(include_filters: Tuple[str, ...], exclude_filters: Tuple[str, ...]) -> KeywordFilter:
+    return KeywordFilter(include_filters, exclude_filters)
+
+def get_filter(include_filters: Sequence[str], exclude_filters: Sequence[str]) -> KeywordFilter:
+    return _compile(tuple(include_filters), tuple(exclude_filters))
+
+def check(keyword_filter: KeywordFilter, text: str, subject: str = "Сообщение") -> bool:
+    result = keyword_filter.match(text)
+
+    if result.exclude_hits:
+        print(f"❌ {subject} содержит исключающее слово '{result.exclude_hits[0]}', пропускаем")
+    elif result.include_hits:
+        print(f"✅ Найдено совпадение по слову '{result.include_hits[0]}'")
+    elif keyword_filter.include_filters:
+        print("❌ Не найдено совпадений по словам для включения, пропускаем")
+
+    return result.accepted
+
+def should_save(text: str, include_filters: Sequence[str], exclude_filters: Sequence[str], subject: str = "Сообщение") -> bool:
+    return check(get_filter(include_filters, exclude_filters), text, subject)
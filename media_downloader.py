@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+import aiohttp
+from async_database import db
+from database import add_media
+from config_store import get_config
+from json_store import load_json, save_json
+import media_store
+
+CHUNK_SIZE = 128 * 1024
+
+# Значения по умолчанию для config['media']; resume_cycles - число циклов, в которые докачивается файл,
+# после чего сообщение уходит без него
+DEFAULT_SETTINGS = {'max_concurrency': 4, 'max_file_size_mb': 50, 'timeout': 120, 'max_retries': 3, 'resume_cycles': 3}
+
+class MediaTooLarge(Exception):
+    pass
+
+class MediaIncomplete(Exception):
+    # Файл не скачан за отведенное время: сообщение нужно обработать еще раз, загрузка продолжится с .part
+    pass
+
+class MediaDownloader:
+    def __init__(self, max_concurrency: int = 4, max_file_size_mb: float = 50, timeout: float = 120,
+                 max_retries: int = 3, resume_cycles: int = 3):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_file_size = int(max_file_size_mb * 1024 * 1024)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.resume_cycles = resume_cycles
+        self.in_progress: Dict[str, asyncio.Future] = {}
+
+    async def _write_chunks(self, part_path: str, chunks: AsyncIterator[bytes], offset: int):
+        written = offset
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            async for chunk in chunks:
+                written += len(chunk)
+                if written > self.max_file_size:
+                    raise MediaTooLarge(f"файл больше {self.max_file_size // (1024 * 1024)} МБ")
+                f.write(chunk)
+
+    async def _download(self, media_key: str, extension: str, owner: str,
+                        fetch: Callable[[str, int], Awaitable[None]]) -> Optional[str]:
+        # Файл, уже скачанный для другого сообщения или репоста, берется из хранилища.
+        # owner - сообщение, которое держит ссылку на файл (media_store.get_owner)
+        stored_path = await db.call(media_store.acquire, media_key, owner)
+        if stored_path:
+            print(f"♻️ Медиафайл {media_key} уже есть в хранилище")
+            return stored_path
+
+        if media_key in self.in_progress:
+            # Тот же файл прямо сейчас скачивается для другого сообщения
+            path, incomplete = await asyncio.shield(self.in_progress[media_key])
+            if path:
+                return await db.call(media_store.acquire, media_key, owner)
+            if incomplete:
+                raise MediaIncomplete(f"медиафайл {media_key} не скачан, докачаем в следующем цикле")
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_progress[media_key] = future
+        path = None
+        incomplete = True
+        try:
+            path = await self._fetch_to_store(media_key, extension, owner, fetch)
+            incomplete = False
+        finally:
+            del self.in_progress[media_key]
+            future.set_result((path, incomplete))
+        return path
+
+    def _count_attempt(self, media_key: str, part_path: str, done: bool = False) -> int:
+        # Число циклов, в которые файл не удалось скачать, хранится рядом с .part
+        attempts_path = os.path.join(os.path.dirname(part_path), 'attempts.json')
+        attempts = load_json(attempts_path, {})
+        count = 0 if done else attempts.get(media_key, 0) + 1
+        if count and count < self.resume_cycles:
+            attempts[media_key] = count
+        elif media_key in attempts:
+            del attempts[media_key]
+        else:
+            return count
+        save_json(attempts_path, attempts)
+        return count
+
+    async def _fetch_to_store(self, media_key: str, extension: str, owner: str,
+                              fetch: Callable[[str, int], Awaitable[None]]) -> Optional[str]:
+        # Файл пишется в .part и попадает в хранилище только целиком, незаконченный .part докачивается
+        part_path = media_store.get_part_path(media_key, extension)
+        file_name = os.path.basename(part_path)[:-5]
+        async with self.semaphore:
+            deadline = time.monotonic() + self.timeout
+            for attempt in range(self.max_retries):
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(fetch(part_path, offset), remaining)
+                    # Хэширование большого файла не должно блокировать цикл событий, запись в базу идет через ее поток
+                    loop = asyncio.get_running_loop()
+                    digest, size = await loop.run_in_executor(None, media_store.hash_file, part_path)
+                    stored_path = await db.call(add_media, digest, media_store.get_store_path(part_path, digest),
+                                                size, owner, media_key)
+                    media_store.place_file(part_path, stored_path)
+                    self._count_attempt(media_key, part_path, done=True)
+                    return stored_path
+                except MediaTooLarge as e:
+                    print(f"⚠️ Медиафайл {file_name} пропущен: {str(e)}")
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    return None
+                except aiohttp.ServerTimeoutError as e:
+                    # Истекло ожидание очередного куска, а не общий лимит: пробуем еще раз с того же места
+                    print(f"❌ Попытка {attempt + 1}/{self.max_retries} скачать медиафайл не удалась: {str(e) or 'таймаут чтения'}")
+                except asyncio.TimeoutError:
+                    break
+                except Exception as e:
+                    print(f"❌ Попытка {attempt + 1}/{self.max_retries} скачать медиафайл не удалась: {str(e)}")
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(min(2 ** attempt, max(deadline - time.monotonic(), 0)))
+
+        count = self._count_attempt(media_key, part_path)
+        if count >= self.resume_cycles:
+            print(f"⚠️ Медиафайл {file_name} не удалось скачать за {count} циклов, сообщение уйдет без него")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+        raise MediaIncomplete(f"медиафайл {file_name} не скачан за {self.timeout} с, докачаем в следующем цикле")
+
+    async def download_url(self, session: aiohttp.ClientSession, url: str, media_key: str, extension: str,
+                           owner: str) -> Optional[str]:
+        async def fetch(part_path: str, offset: int):
+            headers = {'Range': f'bytes={offset}-'} if offset else None
+            # Общий лимит времени задает _download, здесь ограничиваем только ожидание очередного куска
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                if offset and response.status == 416:
+                    return
+                response.raise_for_status()
+                if offset and response.status != 206:
+                    # Сервер не поддерживает докачку и отдает файл целиком
+                    offset = 0
+                if response.content_length and offset + response.content_length > self.max_file_size:
+                    raise MediaTooLarge(f"файл больше {self.max_file_size // (1024 * 1024)} МБ")
+                await self._write_chunks(part_path, response.content.iter_chunked(CHUNK_SIZE), offset)
+
+        return await self._download(media_key, extension, owner, fetch)
+
+    async def download_telegram(self, message, media_key: str, extension: str, owner: str) -> Optional[str]:
+        size = message.file.size if message.file else None
+
+        async def fetch(part_path: str, offset: int):
+            if size and size > self.max_file_size:
+                raise MediaTooLarge(f"файл больше {self.max_file_size // (1024 * 1024)} МБ")
+            if size and offset >= size:
+                return
+            chunks = message.client.iter_download(message.media, offset=offset, request_size=CHUNK_SIZE, file_size=size)
+            await self._write_chunks(part_path, chunks, offset)
+
+        return await self._download(media_key, extension, owner, fetch)
+
+# Один загрузчик на процесс: ограничение параллельности общее для всех парсеров
+_downloader: Optional[MediaDownloader] = None
+_settings: Dict = {}
+
+def get_downloader() -> MediaDownloader:
+    global _downloader, _settings
+    media_config = get_config().get('media', {})
+    settings = {key: media_config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+    if _downloader is None or settings != _settings:
+        _downloader = MediaDownloader(**settings)
+        _settings = settings
+    return _downloader
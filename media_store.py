@@ -0,0 +1,84 @@
+import hashlib
+import os
+from typing import Optional, Tuple, Union
+from config_store import get_config
+from database import acquire_media, forget_media, release_media, release_outbox_media
+
+# Медиафайлы всех источников хранятся один раз под именем из SHA-256 содержимого,
+# а media_key источника (id фото или документа) позволяет не скачивать повторно уже известный файл.
+# Ссылку на файл держит сообщение-владелец, повторная обработка того же сообщения ее не дублирует
+
+def get_owner(source: str, source_id: Union[str, int], message_id: Union[str, int]) -> str:
+    # Совпадает с id сообщения в sent_messages
+    return f"{source}_{source_id}_{message_id}"
+
+def get_message_owner(message: dict) -> str:
+    return get_owner(message['source'], message.get('channel_id') or message.get('owner_id'), message['message_id'])
+
+def get_store_folder() -> str:
+    return get_config().get('media', {}).get('store_folder', 'media')
+
+def get_part_path(media_key: str, extension: str) -> str:
+    folder = os.path.join(get_store_folder(), 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    safe_key = "".join(char if char.isalnum() or char in '-_' else '_' for char in media_key)
+    return os.path.join(folder, f"{safe_key}{extension}.part")
+
+def acquire(media_key: str, owner: str) -> Optional[str]:
+    path = acquire_media(media_key, owner)
+    if path and not os.path.exists(path):
+        # Файл удален с диска вручную: забываем его и скачиваем заново
+        forget_media(path)
+        return None
+    return path
+
+def hash_file(temp_path: str) -> Tuple[str, int]:
+    sha256 = hashlib.sha256()
+    with open(temp_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest(), os.path.getsize(temp_path)
+
+def get_store_path(temp_path: str, digest: str) -> str:
+    extension = os.path.splitext(temp_path[:-5] if temp_path.endswith('.part') else temp_path)[1]
+    folder = os.path.join(get_store_folder(), digest[:2])
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{digest}{extension}")
+
+def place_file(temp_path: str, stored_path: str):
+    # Вызывается после записи файла в базу (database.add_media)
+    if os.path.exists(stored_path):
+        # Такой файл уже есть в хранилище (например, репост из другого канала)
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, stored_path)
+
+def release(path: str, owner: str) -> bool:
+    released = release_media(path, owner)
+    if released is False:
+        return False
+    # Файл без записи в хранилище (сохранен до его появления) удаляется сразу
+    if os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+def release_parsed(messages: list) -> int:
+    # После постановки в очередь файл держит очередь рассылки, ссылка парсера снимается.
+    # Файлы вне хранилища здесь не удаляются: их еще может отправлять очередь
+    removed = 0
+    for message in messages:
+        path = message.get('media_path')
+        if path and release_media(path, get_message_owner(message)) and os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    return removed
+
+def release_delivered() -> int:
+    # Медиафайлы, которые держала только очередь рассылки, удаляются после отправки всем получателям
+    removed = 0
+    for path in release_outbox_media():
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    return removed
@@ -1,87 +1,189 @@
 import json
 import asyncio
 import os
-from telethon import TelegramClient
+from telethon import TelegramClient, events
+from telethon.errors import ChannelPrivateError, ChannelInvalidError
 from datetime import datetime
 from telethon.tl.types import InputPeerChannel, PeerChannel
+from telethon.utils import get_peer_id
+from json_store import load_json, save_json
+from config_store import get_config
+from keyword_filter import should_save
+from media_downloader import MediaIncomplete, get_downloader
+import media_store
 
-def load_config():
-    config_file = 'config.json'
-    if not os.path.exists(config_file):
-        config_file = 'config.example.json'
-        print(f"⚠️ Файл config.json не найден, используем {config_file}")
-        print("⚠️ Создайте файл config.json на основе примера и заполните его вашими данными")
+def create_folders(telegram_config):
+    for folder in [telegram_config['data_folder'], telegram_config['messages_folder'], telegram_config['media_folder']]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+# Папки создаются и при каждом проходе: настройки читаются из config.json заново
+create_folders(get_config()['sources']['telegram'])
+
+# Клиент живет между циклами, когда парсер запущен внутри бота
+client = None
+
+def is_configured(config):
+    # Проверяем настройки Telegram API
+    if config.get('api_id') == "YOUR_TELEGRAM_API_ID" or config.get('api_hash') == "YOUR_TELEGRAM_API_HASH":
+        print("❌ Ошибка: Telegram API ключи не настроены. Отредактируйте config.json")
+        return False
+    return True
+
+async def get_client(config):
+    global client
+    if client is None:
+        print("🔄 Инициализация клиента...")
+        client = TelegramClient('tg_parser_session', config['api_id'], config['api_hash'])
+    
+    if client.is_connected() and await client.is_user_authorized():
+        return client
+    
+    print("🔄 Подключение к Telegram...")
+    await client.start()
+    
+    if not await client.is_user_authorized():
+        print("⚠️ Требуется авторизация.")
+        print("Введите номер телефона в международном формате (например, +375291234567):")
+        phone = input()
+        await client.send_code_request(phone)
+        print("Введите код подтверждения из Telegram:")
+        code = input()
+        await client.sign_in(phone, code)
+        print("✅ Авторизация успешна!")
     
-    with open(config_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    print("✅ Подключение успешно")
+    return client
 
-config = load_config()
-telegram_config = config['sources']['telegram']
+async def close():
+    global client
+    if client is not None:
+        await client.disconnect()
+        client = None
 
-# Проверяем настройки Telegram API
-if config.get('api_id') == "YOUR_TELEGRAM_API_ID" or config.get('api_hash') == "YOUR_TELEGRAM_API_HASH":
-    print("❌ Ошибка: Telegram API ключи не настроены. Отредактируйте config.json")
-    exit(1)
+# Счетчики кэша каналов за текущий цикл
+entity_cache_stats = {'hits': 0, 'misses': 0}
 
-for folder in [telegram_config['data_folder'], telegram_config['messages_folder'], telegram_config['media_folder']]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+def get_entity_cache_path(telegram_config):
+    return os.path.join(telegram_config['data_folder'], 'entities.json')
 
-async def resolve_channel(client, channel_id):
+def load_entity_cache(telegram_config):
+    return load_json(get_entity_cache_path(telegram_config), {})
+
+def save_entity_cache(telegram_config, entity_cache):
+    save_json(get_entity_cache_path(telegram_config), entity_cache)
+
+async def resolve_channel(client, channel_id, entity_cache=None):
+    key = str(channel_id)
+    if entity_cache is not None and key in entity_cache:
+        entity_cache_stats['hits'] += 1
+        cached = entity_cache[key]
+        return InputPeerChannel(cached['id'], cached['access_hash'])
+    
+    entity_cache_stats['misses'] += 1
     try:
         channel = await client.get_input_entity(channel_id)
-        return channel
     except ValueError:
         try:
             if str(channel_id).startswith('-100'):
                 channel_id = int(str(channel_id)[4:])
             channel = await client.get_input_entity(PeerChannel(channel_id))
-            return channel
         except Exception as e:
             print(f"Не удалось получить информацию о канале {channel_id}: {str(e)}")
             return None
+    
+    if entity_cache is not None and isinstance(channel, InputPeerChannel):
+        entity_cache[key] = {'id': channel.channel_id, 'access_hash': channel.access_hash}
+    return channel
 
-async def get_saved_messages():
-    saved_messages = set()
-    try:
-        for filename in os.listdir(telegram_config['messages_folder']):
-            if filename.endswith('.json'):
-                file_path = os.path.join(telegram_config['messages_folder'], filename)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    messages = json.load(f)
-                    for msg in messages:
-                        msg_id = f"tg_{msg['channel_id']}_{msg['message_id']}"
-                        saved_messages.add(msg_id)
-    except Exception as e:
-        print(f"Ошибка при чтении сохраненных сообщений: {str(e)}")
-    return saved_messages
+async def fetch_new_messages(client, channel, last_seen_id, max_messages):
+    if last_seen_id is None:
+        # Канал проверяется впервые: берем только последнее сообщение
+        return await client.get_messages(channel, limit=1)
+    return [message async for message in client.iter_messages(
+        channel, min_id=last_seen_id, reverse=True, limit=max_messages
+    )]
+
+def get_last_seen_path(telegram_config):
+    return os.path.join(telegram_config['data_folder'], 'last_seen.json')
+
+def load_last_seen(telegram_config):
+    return load_json(get_last_seen_path(telegram_config), {})
+
+def save_last_seen(telegram_config, last_seen):
+    save_json(get_last_seen_path(telegram_config), last_seen)
+
+def get_media_retries_path(telegram_config):
+    return os.path.join(telegram_config['data_folder'], 'media_retries.json')
+
+def load_media_retries(telegram_config):
+    # Сообщения, медиафайл которых не докачан: id канала -> список id сообщений
+    return load_json(get_media_retries_path(telegram_config), {})
+
+def update_media_retries(telegram_config, retried, failed):
+    # Файл перечитывается перед записью: его же обновляет обработка сообщений из потока
+    media_retries = load_media_retries(telegram_config)
+    for channel_id, message_ids in retried.items():
+        media_retries[channel_id] = [i for i in media_retries.get(channel_id, []) if i not in message_ids]
+    for channel_id, message_ids in failed.items():
+        media_retries.setdefault(channel_id, []).extend(i for i in message_ids if i not in media_retries[channel_id])
+    save_json(get_media_retries_path(telegram_config), {key: ids for key, ids in media_retries.items() if ids})
 
 def should_save_message(message, channel_settings):
     if not message.text:
         return False
-        
-    text = message.text.lower()
     
-    for word in channel_settings['exclude_filters']:
-        if word.lower() in text:
-            print(f"❌ Сообщение содержит исключающее слово '{word}', пропускаем")
-            return False
+    return should_save(message.text, channel_settings['include_filters'], channel_settings['exclude_filters'])
+
+async def build_message_info(message, channel_id, telegram_config):
+    message_info = {
+        'source': 'telegram',
+        'channel_id': channel_id,
+        'message_id': message.id,
+        'date': message.date.isoformat(),
+        'text': message.text,
+        'views': message.views if hasattr(message, 'views') else None,
+        'media_type': None,
+        'media_path': None
+    }
+
+    if message.media:
+        # id фото и документов Telegram сохраняется при пересылке, поэтому репост не скачивается повторно
+        owner = media_store.get_owner('telegram', channel_id, message.id)
+        if hasattr(message.media, 'photo'):
+            message_info['media_type'] = 'photo'
+            media_key = f"tg_photo_{message.media.photo.id}"
+            message_info['media_path'] = await get_downloader().download_telegram(message, media_key, '.jpg', owner)
+            
+        elif hasattr(message.media, 'document'):
+            for attribute in message.media.document.attributes:
+                if hasattr(attribute, 'mime_type'):
+                    message_info['media_type'] = attribute.mime_type
+                elif hasattr(attribute, 'animated'):
+                    message_info['media_type'] = 'gif'
+            
+            extension = '.mp4' if message_info['media_type'] == 'video' else '.gif'
+            media_key = f"tg_document_{message.media.document.id}"
+            message_info['media_path'] = await get_downloader().download_telegram(message, media_key, extension, owner)
     
-    if channel_settings['include_filters']:
-        for word in channel_settings['include_filters']:
-            if word.lower() in text:
-                print(f"✅ Найдено совпадение по слову '{word}'")
-                return True
-        print("❌ Не найдено совпадений по словам для включения, пропускаем")
-        return False
+    return message_info
+
+def save_messages(messages_data, telegram_config):
+    # Микросекунды в имени, чтобы сообщения из потока, пришедшие в одну секунду, не перезаписывали друг друга
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    output_file = os.path.join(telegram_config['messages_folder'], f'messages_{timestamp}.json')
     
-    return True
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(messages_data, f, ensure_ascii=False, indent=4)
+    
+    return output_file
 
 async def get_last_messages():
     messages_data = []
+    pending = []
     
     try:
-        config = load_config()
+        config = get_config()
         telegram_config = config['sources']['telegram']
         
         if not telegram_config.get('enabled', False):
@@ -93,132 +195,129 @@ async def get_last_messages():
         if not channels:
             print("❌ Нет добавленных Telegram каналов")
             return False
+        
+        create_folders(telegram_config)
             
         active_channels = [channel_id for channel_id, settings in channels.items() if settings['active']]
         if not active_channels:
             print("❌ Нет активных Telegram каналов")
             return False
         
-        saved_messages = await get_saved_messages()
-        
-        print("🔄 Инициализация клиента...")
-        client = TelegramClient('tg_parser_session', config['api_id'], config['api_hash'])
+        last_seen = load_last_seen(telegram_config)
+        media_retries = load_media_retries(telegram_config)
+        retried = {}
+        failed = {}
+        entity_cache = load_entity_cache(telegram_config)
+        entity_cache_stats['hits'] = entity_cache_stats['misses'] = 0
+        max_messages = telegram_config.get('max_messages_per_cycle', 50)
         
         try:
-            print("🔄 Подключение к Telegram...")
-            await client.start()
-            
-            if not await client.is_user_authorized():
-                print("⚠️ Требуется авторизация.")
-                print("Введите номер телефона в международном формате (например, +375291234567):")
-                phone = input()
-                await client.send_code_request(phone)
-                print("Введите код подтверждения из Telegram:")
-                code = input()
-                await client.sign_in(phone, code)
-                print("✅ Авторизация успешна!")
-            
-            print("✅ Подключение успешно")
-            
+            client = await get_client(config)
         except Exception as e:
             print(f"❌ Ошибка при подключении к Telegram: {str(e)}")
             if hasattr(e, '__class__'):
                 print(f"Тип ошибки: {e.__class__.__name__}")
+            await close()
             return False
         
         try:
-            async with client:
-                for channel_id, settings in channels.items():
-                    if not settings['active']:
-                        print(f"ℹ️ Telegram канал {channel_id} неактивен, пропускаем")
+            for channel_id, settings in channels.items():
+                if not settings['active']:
+                    print(f"ℹ️ Telegram канал {channel_id} неактивен, пропускаем")
+                    continue
+                    
+                try:
+                    print(f"🔍 Подключаемся к каналу {channel_id}...")
+                    channel_id = int(channel_id)
+                    channel = await resolve_channel(client, channel_id, entity_cache)
+                    if not channel:
+                        print(f"⚠️ Пропускаю Telegram канал {channel_id} - не удалось получить доступ")
                         continue
                         
+                    print(f"🔍 Проверяю Telegram канал {channel_id}...")
+                    
+                    last_seen_id = last_seen.get(str(channel_id))
                     try:
-                        print(f"🔍 Подключаемся к каналу {channel_id}...")
-                        channel_id = int(channel_id)
-                        channel = await resolve_channel(client, channel_id)
+                        messages = await fetch_new_messages(client, channel, last_seen_id, max_messages)
+                    except (ChannelPrivateError, ChannelInvalidError, ValueError) as e:
+                        # Сохраненный access_hash больше не действует: сбрасываем кэш и пробуем получить канал заново
+                        entity_cache.pop(str(channel_id), None)
+                        if isinstance(e, ChannelPrivateError):
+                            raise
+                        print(f"⚠️ Данные канала {channel_id} в кэше устарели, получаем заново")
+                        channel = await resolve_channel(client, channel_id, entity_cache)
                         if not channel:
                             print(f"⚠️ Пропускаю Telegram канал {channel_id} - не удалось получить доступ")
                             continue
-                            
-                        print(f"🔍 Проверяю Telegram канал {channel_id}...")
-                        
-                        messages = await client.get_messages(channel, limit=1)
-                        if not messages or len(messages) == 0:
-                            print(f"ℹ️ В Telegram канале {channel_id} нет сообщений")
-                            continue
-                            
-                        message = messages[0]
-                        
-                        msg_id = f"tg_{channel_id}_{message.id}"
-                        if msg_id in saved_messages:
-                            print(f"✓ Сообщение {msg_id} уже сохранено, пропускаем")
-                            continue
-                        
-                        if not should_save_message(message, settings):
-                            continue
-                        
-                        message_info = {
-                            'source': 'telegram',
-                            'channel_id': channel_id,
-                            'message_id': message.id,
-                            'date': message.date.isoformat(),
-                            'text': message.text,
-                            'views': message.views if hasattr(message, 'views') else None,
-                            'media_type': None,
-                            'media_path': None
-                        }
-
-                        if message.media:
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            if hasattr(message.media, 'photo'):
-                                message_info['media_type'] = 'photo'
-                                file_path = os.path.join(telegram_config['media_folder'], f"photo_{timestamp}.jpg")
-                                await message.download_media(file_path)
-                                message_info['media_path'] = file_path
-                                
-                            elif hasattr(message.media, 'document'):
-                                for attribute in message.media.document.attributes:
-                                    if hasattr(attribute, 'mime_type'):
-                                        message_info['media_type'] = attribute.mime_type
-                                    elif hasattr(attribute, 'animated'):
-                                        message_info['media_type'] = 'gif'
-                                
-                                extension = '.mp4' if message_info['media_type'] == 'video' else '.gif'
-                                file_path = os.path.join(telegram_config['media_folder'], f"media_{timestamp}{extension}")
-                                await message.download_media(file_path)
-                                message_info['media_path'] = file_path
-                        
-                        messages_data.append(message_info)
-                        print(f"✅ Получено новое сообщение из Telegram канала {channel_id}")
-                        if message_info['media_path']:
-                            print(f"📎 Медиафайл сохранен: {message_info['media_path']}")
+                        messages = await fetch_new_messages(client, channel, last_seen_id, max_messages)
+                    
+                    # Сообщения с недокачанным медиафайлом остались позади last_seen и запрашиваются по id
+                    retry_ids = media_retries.get(str(channel_id))
+                    if retry_ids:
+                        retry_messages = await client.get_messages(channel, ids=retry_ids)
+                        retried[str(channel_id)] = retry_ids
+                        for message in retry_messages:
+                            if message is not None and should_save_message(message, settings):
+                                task = asyncio.ensure_future(build_message_info(message, channel_id, telegram_config))
+                                pending.append((channel_id, message.id, task))
+                    
+                    if not messages:
+                        print(f"ℹ️ В Telegram канале {channel_id} нет новых сообщений")
+                        continue
+                    
+                    print(f"📥 Получено {len(messages)} новых сообщений из Telegram канала {channel_id}")
+                    if len(messages) >= max_messages:
+                        print(f"✋ Достигнут лимит в {max_messages} сообщений, остальные будут получены в следующем цикле")
+                    
+                    for message in messages:
+                        if should_save_message(message, settings):
+                            # Медиафайлы скачиваются в фоне, пока проверяются следующие каналы
+                            task = asyncio.ensure_future(build_message_info(message, channel_id, telegram_config))
+                            pending.append((channel_id, message.id, task))
                         
-                    except Exception as e:
-                        print(f"❌ Ошибка при получении сообщения из Telegram канала {channel_id}: {str(e)}")
-                        if hasattr(e, '__class__'):
-                            print(f"Тип ошибки: {e.__class__.__name__}")
+                        last_seen[str(channel_id)] = message.id
+                    
+                except Exception as e:
+                    print(f"❌ Ошибка при получении сообщения из Telegram канала {channel_id}: {str(e)}")
+                    if hasattr(e, '__class__'):
+                        print(f"Тип ошибки: {e.__class__.__name__}")
             
-            if messages_data:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_file = os.path.join(telegram_config['messages_folder'], f'messages_{timestamp}.json')
-                
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(messages_data, f, ensure_ascii=False, indent=4)
+            for channel_id, message_id, task in pending:
+                try:
+                    message_info = await task
+                except MediaIncomplete as e:
+                    print(f"⏳ Сообщение {message_id} из Telegram канала {channel_id} отложено: {str(e)}")
+                    failed.setdefault(str(channel_id), []).append(message_id)
+                    continue
+                except Exception as e:
+                    print(f"❌ Ошибка при обработке сообщения {message_id} из Telegram канала {channel_id}: {str(e)}")
+                    continue
                 
+                messages_data.append(message_info)
+                print(f"✅ Получено новое сообщение {message_id} из Telegram канала {channel_id}")
+                if message_info['media_path']:
+                    print(f"📎 Медиафайл сохранен: {message_info['media_path']}")
+            
+            if messages_data:
+                output_file = save_messages(messages_data, telegram_config)
                 print(f"✅ Новые сообщения сохранены в файл: {output_file}")
-                return True
             else:
                 print("ℹ️ Нет новых сообщений для сохранения")
-                return False
+            
+            save_last_seen(telegram_config, last_seen)
+            update_media_retries(telegram_config, retried, failed)
+            save_entity_cache(telegram_config, entity_cache)
+            print(f"📊 Кэш каналов: {entity_cache_stats['hits']} попаданий, {entity_cache_stats['misses']} промахов")
+            return bool(messages_data)
         
         except Exception as e:
             print(f"❌ Произошла общая ошибка: {str(e)}")
             if hasattr(e, '__class__'):
                 print(f"Тип ошибки: {e.__class__.__name__}")
+            for _, _, task in pending:
+                task.cancel()
+            await close()
             return False
-        finally:
-            await client.disconnect()
             
     except Exception as e:
         print(f"❌ Критическая ошибка: {str(e)}")
@@ -226,6 +325,128 @@ async def get_last_messages():
             print(f"Тип ошибки: {e.__class__.__name__}")
         return False
 
+def get_marked_channel_id(channel_id):
+    # В config.json канал может быть записан как -100… или как id без префикса, события приходят с -100…
+    channel_id = int(channel_id)
+    return get_peer_id(PeerChannel(channel_id)) if channel_id > 0 else channel_id
+
+def get_stream_channels(config):
+    telegram_config = config['sources']['telegram']
+    if not telegram_config.get('enabled', False) or telegram_config.get('mode') != 'stream':
+        return None
+    # id из события -> (id как в config.json, настройки); отметки last_seen ведутся по id из config.json, как при опросе
+    return {
+        get_marked_channel_id(channel_id): (int(channel_id), settings)
+        for channel_id, settings in telegram_config.get('channels', {}).items() if settings['active']
+    }
+
+async def stream(on_message, catch_up=None, refresh_interval=30):
+    config = get_config()
+    channels = get_stream_channels(config)
+    if channels is None or not is_configured(config):
+        return False
+    
+    create_folders(config['sources']['telegram'])
+    client = await get_client(config)
+    last_seen = {}
+    # События, пришедшие во время догоняющего прохода, обрабатываются после него
+    buffered = []
+    catching_up = catch_up is not None
+    
+    async def process(event):
+        entry = channels.get(event.chat_id)
+        if entry is None:
+            return
+        channel_id, settings = entry
+        
+        try:
+            msg_id = f"tg_{channel_id}_{event.message.id}"
+            print(f"📨 Новое сообщение {msg_id} из Telegram канала {channel_id}")
+            
+            if event.message.id <= last_seen.get(str(channel_id), 0):
+                print(f"✓ Сообщение {msg_id} уже обработано, пропускаем")
+                return
+            
+            message_info = None
+            if should_save_message(event.message, settings):
+                try:
+                    message_info = await build_message_info(event.message, channel_id, config['sources']['telegram'])
+                except MediaIncomplete as e:
+                    # Сообщение будет обработано снова догоняющим проходом
+                    print(f"⏳ Сообщение {msg_id} отложено: {str(e)}")
+                    update_media_retries(config['sources']['telegram'], {}, {str(channel_id): [event.message.id]})
+            if message_info:
+                save_messages([message_info], config['sources']['telegram'])
+                if message_info['media_path']:
+                    print(f"📎 Медиафайл сохранен: {message_info['media_path']}")
+            
+            last_seen[str(channel_id)] = max(event.message.id, last_seen.get(str(channel_id), 0))
+            save_last_seen(config['sources']['telegram'], last_seen)
+            
+            if message_info:
+                await on_message(message_info)
+        except Exception as e:
+            print(f"❌ Ошибка при обработке сообщения из Telegram канала {channel_id}: {str(e)}")
+    
+    async def handler(event):
+        if catching_up:
+            buffered.append(event)
+            return
+        await process(event)
+    
+    async def run_catch_up():
+        nonlocal catching_up
+        catching_up = True
+        try:
+            await catch_up()
+        except Exception as e:
+            print(f"❌ Ошибка при догоняющем проходе Telegram: {str(e)}")
+        # Догоняющий проход сдвигает отметки в файле, буферизованные сообщения до них пропускаются
+        last_seen.update(load_last_seen(config['sources']['telegram']))
+        # Новые события продолжают копиться, пока буфер не разобран, чтобы не обогнать более старые
+        while buffered:
+            await process(buffered.pop(0))
+        catching_up = False
+    
+    # Подписка регистрируется до догоняющего прохода, иначе сообщения, опубликованные во время него, потеряются
+    client.add_event_handler(handler, events.NewMessage(func=lambda e: e.is_channel))
+    print(f"📡 Подписка на новые сообщения из {len(channels)} Telegram каналов")
+    
+    try:
+        if catch_up is not None:
+            await run_catch_up()
+        else:
+            last_seen.update(load_last_seen(config['sources']['telegram']))
+        
+        # Подписка обновляется без переподключения: добавленные и удаленные каналы подхватываются из config.json
+        while client.is_connected():
+            await asyncio.sleep(refresh_interval)
+            config = get_config()
+            updated_channels = get_stream_channels(config)
+            if updated_channels is None:
+                print("ℹ️ Потоковый режим Telegram отключен")
+                break
+            channels.clear()
+            channels.update(updated_channels)
+            # Отложенные сообщения с недокачанными медиафайлами обрабатывает догоняющий проход
+            if catch_up is not None and load_media_retries(config['sources']['telegram']):
+                await run_catch_up()
+    finally:
+        client.remove_event_handler(handler)
+    
+    return True
+
+async def main():
+    if not is_configured(get_config()):
+        return False
+    return await get_last_messages()
+
+async def run_once():
+    try:
+        return await main()
+    finally:
+        await close()
+
 if __name__ == '__main__':
-    success = asyncio.run(get_last_messages())
+    success = asyncio.run(run_once())
     exit(0 if success else 1)
\ No newline at end of file
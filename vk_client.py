@@ -0,0 +1,86 @@
+import asyncio
+from typing import Any, Dict, Optional
+import aiohttp
+from rate_limiter import TokenBucket
+from http_cache import get_http_cache
+
+API_URL = "https://api.vk.com/method/"
+API_VERSION = "5.131"
+
+# Коды ошибок VK, после которых запрос можно повторить: слишком много запросов в секунду и внутренняя ошибка сервера
+RETRY_ERRORS = {6, 10}
+
+class VKAPIError(Exception):
+    def __init__(self, error: Dict):
+        self.code = error.get('error_code')
+        self.message = error.get('error_msg', '')
+        super().__init__(f"[{self.code}] {self.message}")
+
+class VKClient:
+    def __init__(self, token: str, requests_per_second: float = 3, timeout: float = 30,
+                 max_connections: int = 10, version: str = API_VERSION):
+        self.token = token
+        self.version = version
+        self.limiter = TokenBucket(requests_per_second)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_connections = max_connections
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Одна сессия на клиента: соединения с api.vk.com переиспользуются между запросами и циклами
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def call(self, method: str, max_retries: int = 3, **params) -> Any:
+        data = {key: value for key, value in params.items() if value is not None}
+        data['access_token'] = self.token
+        data['v'] = self.version
+
+        # VK не отдает ETag, поэтому ответы медленно меняющихся методов кэшируются только на время жизни
+        url = API_URL + method
+        cache = get_http_cache()
+        key = None
+        if cache.is_cacheable(url):
+            key = cache.make_key(url, data)
+            entry = cache.load(key)
+            if entry and cache.is_fresh(entry):
+                return cache.hit(key, entry)
+
+        error = None
+        for attempt in range(max_retries):
+            await self.limiter.acquire()
+            try:
+                async with self.get_session().post(url, data=data) as response:
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == max_retries - 1:
+                    raise
+                print(f"⚠️ Попытка {attempt + 1}/{max_retries} запроса {method} не удалась: {str(e)}")
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            if 'error' in result:
+                error = VKAPIError(result['error'])
+                if error.code not in RETRY_ERRORS:
+                    raise error
+                print(f"⚠️ Попытка {attempt + 1}/{max_retries} запроса {method} не удалась: {str(error)}")
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(2 ** attempt)
+                continue
+            if key:
+                cache.store(key, url, result['response'], response.headers)
+            return result['response']
+
+        # Повторы исчерпаны: ошибка не должна превращаться в пустой ответ
+        raise error or VKAPIError({'error_msg': f"запрос {method} не выполнен за {max_retries} попыток"})
+
+    async def execute(self, code: str) -> Any:
+        return await self.call('execute', code=code)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
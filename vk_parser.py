@@ -3,126 +3,111 @@ import asyncio
 import os
 from datetime import datetime
 from typing import Optional, List, Dict
-import vk_api
-import requests
 import time
-import sqlite3
-
-def load_config():
-    config_file = 'config.json'
-    if not os.path.exists(config_file):
-        config_file = 'config.example.json'
-        print(f"⚠️ Файл config.json не найден, используем {config_file}")
-        print("⚠️ Создайте файл config.json на основе примера и заполните его вашими данными")
-    
-    with open(config_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-config = load_config()
-vk_config = config['sources'].get('vk', {})
-
-# Проверяем настройки VK API
-if vk_config.get('service_token') == "YOUR_VK_SERVICE_TOKEN":
-    print("❌ Ошибка: VK API токен не настроен. Отредактируйте config.json")
-    exit(1)
-
-for folder in [vk_config.get('data_folder'), vk_config.get('messages_folder'), vk_config.get('media_folder')]:
-    if folder and not os.path.exists(folder):
-        os.makedirs(folder)
+from keyword_filter import should_save
+from async_database import db
+from database import is_message_sent
+from config_store import get_config
+from json_store import load_json, save_json
+from vk_client import VKAPIError, VKClient
+from media_downloader import MediaIncomplete, get_downloader
+from http_cache import get_http_cache
+import media_store
+
+def create_folders(vk_config: Dict):
+    for folder in [vk_config.get('data_folder'), vk_config.get('messages_folder'), vk_config.get('media_folder')]:
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+create_folders(get_config()['sources'].get('vk', {}))
+
+# Экземпляр парсера живет между циклами, когда парсер запущен внутри бота
+parser = None
 
 class VKParser:
-    def __init__(self, service_token: str):
+    def __init__(self, service_token: str, vk_config: Dict):
         try:
-            self.vk = vk_api.VkApi(token=service_token)
-            self.api = self.vk.get_api()
+            self.service_token = service_token
+            # Настройки обновляет main() перед каждым циклом
+            self.vk_config = vk_config
+            self.requests_per_second = vk_config.get('requests_per_second', 3)
+            self.api = VKClient(service_token, requests_per_second=self.requests_per_second)
             print("✅ VK API успешно инициализирован")
         except Exception as e:
             print(f"❌ Ошибка при инициализации VK API: {str(e)}")
             raise
 
-    async def get_group_id(self, group_name: str) -> Optional[int]:
-        try:
-            group_name = group_name.lstrip('-')
-            response = self.api.groups.getById(group_id=group_name)
-            if response:
-                return -response[0]['id']
-            return None
-        except Exception as e:
-            print(f"❌ Ошибка при получении ID группы {group_name}: {str(e)}")
-            return None
+    def get_group_cache_path(self) -> str:
+        return os.path.join(self.vk_config.get('data_folder', 'vk'), 'groups.json')
 
-    async def get_saved_messages(self) -> set:
-        saved_messages = set()
-        try:
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute('SELECT message_id FROM sent_messages WHERE source = "vk"')
-            for row in c.fetchall():
-                msg_id = row[0]
-                saved_messages.add(msg_id)
-            conn.close()
-            print(f"✅ Загружено {len(saved_messages)} сохраненных сообщений из базы данных")
-        except Exception as e:
-            print(f"❌ Ошибка при чтении сохраненных сообщений из базы данных: {str(e)}")
-            
+    async def resolve_group_ids(self, group_names: List[str]) -> Dict[str, int]:
+        # Короткие имена групп почти не меняются, поэтому ID хранятся в кэше на диске
+        group_cache = load_json(self.get_group_cache_path(), {})
+        ttl = self.vk_config.get('group_cache_ttl', 7 * 24 * 3600)
+        now = time.time()
+
+        group_ids = {}
+        missing = []
+        for group_name in group_names:
+            cached = group_cache.get(group_name)
+            if cached and now - cached.get('resolved_at', 0) < ttl:
+                # id = None: VK не нашел группу, до истечения срока кэша имя повторно не запрашивается
+                if cached['id'] is not None:
+                    group_ids[group_name] = cached['id']
+            else:
+                missing.append(group_name)
+
+        print(f"📊 Кэш групп VK: {len(group_names) - len(missing)} попаданий, {len(missing)} промахов")
+        if not missing:
+            return group_ids
+
+        # groups.getById принимает до 500 групп за один запрос
+        batches = [missing[start:start + 500] for start in range(0, len(missing), 500)]
+        while batches:
+            batch = batches.pop(0)
             try:
-                for filename in os.listdir(vk_config['messages_folder']):
-                    if filename.endswith('.json'):
-                        file_path = os.path.join(vk_config['messages_folder'], filename)
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            messages = json.load(f)
-                            for msg in messages:
-                                msg_id = f"vk_{msg['owner_id']}_{msg['message_id']}"
-                                saved_messages.add(msg_id)
-                print(f"✅ Загружено {len(saved_messages)} сохраненных сообщений из файлов")
+                response = await self.api.call('groups.getById', group_ids=",".join(name.lstrip('-') for name in batch))
             except Exception as e:
-                print(f"❌ Ошибка при чтении сохраненных сообщений из файлов: {str(e)}")
-        return saved_messages
+                if len(batch) > 1:
+                    # Одно неверное имя ломает весь запрос, поэтому проверяем группы по одной
+                    print(f"⚠️ Ошибка при получении ID групп, проверяю по одной: {str(e)}")
+                    batches.extend([group_name] for group_name in batch)
+                else:
+                    print(f"❌ Ошибка при получении ID группы {batch[0]}: {str(e)}")
+                    # Отказ VK API запоминается, сетевые ошибки и исчерпанные повторы - нет
+                    if isinstance(e, VKAPIError) and e.code is not None:
+                        group_cache[batch[0]] = {'id': None, 'resolved_at': now}
+                continue
+            if isinstance(response, dict):
+                response = response.get('groups', [])
+
+            resolved = {}
+            for group in response:
+                keys = {str(group['id']), f"club{group['id']}", f"public{group['id']}", f"event{group['id']}"}
+                if group.get('screen_name'):
+                    keys.add(group['screen_name'].lower())
+                for key in keys:
+                    resolved[key] = -group['id']
+
+            for group_name in batch:
+                group_id = resolved.get(group_name.lstrip('-').lower())
+                if group_id:
+                    group_ids[group_name] = group_id
+                group_cache[group_name] = {'id': group_id, 'resolved_at': now}
+
+        save_json(self.get_group_cache_path(), group_cache)
+        return group_ids
 
     def should_save_message(self, text: str, group_settings: Dict) -> bool:
         if not text:
             return False
             
-        text = text.lower()
-        
-        for word in group_settings['exclude_filters']:
-            if word.lower() in text:
-                print(f"❌ Сообщение содержит исключающее слово '{word}', пропускаем")
-                return False
-        
-        if group_settings['include_filters']:
-            for word in group_settings['include_filters']:
-                if word.lower() in text:
-                    print(f"✅ Найдено совпадение по слову '{word}'")
-                    return True
-            print("❌ Не найдено совпадений по словам для включения, пропускаем")
-            return False
-        
-        return True
+        return should_save(text, group_settings['include_filters'], group_settings['exclude_filters'])
 
-    async def download_media(self, url: str, file_path: str) -> bool:
-        max_retries = 3
-        retry_delay = 1
-
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(url, timeout=10)
-                response.raise_for_status()
-                
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                return True
-                
-            except requests.exceptions.RequestException as e:
-                print(f"❌ Попытка {attempt + 1}/{max_retries} скачать медиафайл не удалась: {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                continue
-                
-        return False
+    async def download_media(self, url: str, media_key: str, extension: str, owner: str) -> Optional[str]:
+        return await get_downloader().download_url(self.api.get_session(), url, media_key, extension, owner)
 
-    async def process_attachments(self, post: Dict, timestamp: str) -> Optional[Dict]:
+    async def process_attachments(self, post: Dict, group_id: int) -> Optional[Dict]:
         if 'attachments' not in post:
             return None
 
@@ -133,8 +118,9 @@ class VKParser:
                     max_size = max(sizes, key=lambda x: x['width'] * x['height'])
                     url = max_size['url']
                     
-                    file_path = os.path.join(vk_config['media_folder'], f"photo_{timestamp}.jpg")
-                    if await self.download_media(url, file_path):
+                    media_key = f"vk_photo_{att['photo']['owner_id']}_{att['photo']['id']}"
+                    file_path = await self.download_media(url, media_key, '.jpg', media_store.get_owner('vk', group_id, post['id']))
+                    if file_path:
                         return {
                             'media_type': 'photo',
                             'media_path': file_path
@@ -150,79 +136,147 @@ class VKParser:
                             'title': att['video']['title']
                         }
                     }
+            except MediaIncomplete:
+                raise
             except Exception as e:
                 print(f"❌ Ошибка при обработке вложения типа {att['type']}: {str(e)}")
                 continue
 
         return None
 
+    async def build_message_info(self, post: Dict, group_id: int) -> Dict:
+        media_info = await self.process_attachments(post, group_id)
+        return {
+            'source': 'vk',
+            'owner_id': group_id,
+            'message_id': post['id'],
+            'date': datetime.fromtimestamp(post['date']).isoformat(),
+            'text': post.get('text', ''),
+            'likes': post.get('likes', {}).get('count', 0),
+            'reposts': post.get('reposts', {}).get('count', 0),
+            'views': post.get('views', {}).get('count', 0),
+            'media_type': media_info['media_type'] if media_info else None,
+            'media_path': media_info['media_path'] if media_info else None
+        }
+
+    def build_wall_script(self, owner_ids: List[int], count: int) -> str:
+        calls = ", ".join(f'API.wall.get({{"owner_id": {owner_id}, "count": {count}}})' for owner_id in owner_ids)
+        return f"return [{calls}];"
+
+    async def fetch_walls(self, groups: Dict[str, int]) -> Dict[str, Optional[List[Dict]]]:
+        count = self.vk_config.get('posts_per_group', 5)
+        walls = {}
+
+        if self.vk_config.get('fetch_mode', 'single') != 'execute':
+            async def fetch_wall(group_name, group_id):
+                print(f"🔍 Проверяю группу {group_name} (ID: {group_id})...")
+                try:
+                    posts = await self.api.call('wall.get', owner_id=group_id, count=count)
+                    walls[group_name] = posts['items']
+                except Exception as e:
+                    print(f"❌ Ошибка при получении постов из группы {group_name}: {str(e)}")
+                    walls[group_name] = None
+
+            # Запросы идут параллельно, частоту ограничивает VKClient
+            await asyncio.gather(*(fetch_wall(group_name, group_id) for group_name, group_id in groups.items()))
+            return walls
+
+        # execute принимает не больше 25 вызовов API за один запрос
+        batch_size = max(1, min(self.vk_config.get('batch_size', 25), 25))
+        names = list(groups)
+
+        async def fetch_batch(start):
+            batch = names[start:start + batch_size]
+            print(f"🔍 Проверяю группы {start + 1}-{start + len(batch)} из {len(names)} одним запросом execute...")
+            try:
+                results = await self.api.execute(self.build_wall_script([groups[name] for name in batch], count))
+            except Exception as e:
+                print(f"❌ Ошибка при выполнении execute: {str(e)}")
+                results = []
+
+            # Неудачный вызов внутри execute возвращает false вместо ответа
+            for position, group_name in enumerate(batch):
+                result = results[position] if position < len(results) else None
+                if not result:
+                    print(f"❌ Ошибка при получении постов из группы {group_name}")
+                    walls[group_name] = None
+                else:
+                    walls[group_name] = result['items']
+
+        await asyncio.gather(*(fetch_batch(start) for start in range(0, len(names), batch_size)))
+        return walls
+
     async def get_last_messages(self) -> bool:
         messages_data = []
-        saved_messages = await self.get_saved_messages()
         
         try:
-            for group_name, settings in vk_config['groups'].items():
+            active_groups = []
+            for group_name, settings in self.vk_config['groups'].items():
                 if not settings.get('active', False):
                     print(f"ℹ️ Группа {group_name} неактивна, пропускаем")
                     continue
-                    
-                try:
-                    group_id = await self.get_group_id(group_name)
-                    if not group_id:
-                        print(f"❌ Не удалось получить ID группы {group_name}, пропускаем")
-                        continue
+                active_groups.append(group_name)
 
-                    print(f"🔍 Проверяю группу {group_name} (ID: {group_id})...")
-                    
-                    posts = self.api.wall.get(owner_id=group_id, count=5)
-                    print(f"✅ Получено {len(posts['items'])} постов из группы {group_name}")
+            group_ids = await self.resolve_group_ids(active_groups)
+            groups = {}
+            for group_name in active_groups:
+                if group_name not in group_ids:
+                    print(f"❌ Не удалось получить ID группы {group_name}, пропускаем")
+                    continue
+                groups[group_name] = group_ids[group_name]
+
+            walls = await self.fetch_walls(groups)
+
+            # Вложения скачиваются параллельно, пока перебираются посты остальных групп
+            pending = []
+            for group_name, group_id in groups.items():
+                settings = self.vk_config['groups'][group_name]
+                posts = walls.get(group_name)
+                if posts is None:
+                    continue
+
+                print(f"✅ Получено {len(posts)} постов из группы {group_name}")
+                # Проверка всех постов группы одним обращением к потоку базы
+                sent_flags = await db.call_many([(is_message_sent, 'vk', str(group_id), str(post['id'])) for post in posts])
                     
-                    for post in posts['items']:
-                        try:
-                            msg_id = f"vk_{group_id}_{post['id']}"
-                            
-                            if msg_id in saved_messages:
-                                print(f"✓ Сообщение {msg_id} уже сохранено, пропускаем")
-                                continue
-                            
-                            if not self.should_save_message(post.get('text', ''), settings):
-                                continue
-                            
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            
-                            media_info = await self.process_attachments(post, timestamp)
-                            
-                            message_info = {
-                                'source': 'vk',
-                                'owner_id': group_id,
-                                'message_id': post['id'],
-                                'date': datetime.fromtimestamp(post['date']).isoformat(),
-                                'text': post.get('text', ''),
-                                'likes': post.get('likes', {}).get('count', 0),
-                                'reposts': post.get('reposts', {}).get('count', 0),
-                                'views': post.get('views', {}).get('count', 0),
-                                'media_type': media_info['media_type'] if media_info else None,
-                                'media_path': media_info['media_path'] if media_info else None
-                            }
-                            
-                            messages_data.append(message_info)
-                            print(f"✅ Получено новое сообщение из группы {group_name}")
-                            if message_info['media_path']:
-                                print(f"📎 Медиафайл сохранен: {message_info['media_path']}")
-                                
-                        except Exception as e:
-                            print(f"❌ Ошибка при обработке поста из группы {group_name}: {str(e)}")
+                for post, sent in zip(posts, sent_flags):
+                    try:
+                        msg_id = f"vk_{group_id}_{post['id']}"
+                        
+                        if sent:
+                            print(f"✓ Сообщение {msg_id} уже сохранено, пропускаем")
+                            continue
+                        
+                        if not self.should_save_message(post.get('text', ''), settings):
                             continue
+                        
+                        pending.append((group_name, asyncio.ensure_future(self.build_message_info(post, group_id))))
                             
+                    except Exception as e:
+                        print(f"❌ Ошибка при обработке поста из группы {group_name}: {str(e)}")
+                        continue
+
+            for group_name, task in pending:
+                try:
+                    message_info = await task
+                except MediaIncomplete as e:
+                    # Пост не отмечен отправленным, поэтому в следующем цикле он будет обработан снова
+                    print(f"⏳ Пост из группы {group_name} отложен: {str(e)}")
+                    continue
                 except Exception as e:
-                    print(f"❌ Ошибка при получении постов из группы {group_name}: {str(e)}")
+                    print(f"❌ Ошибка при обработке поста из группы {group_name}: {str(e)}")
                     continue
-                    
-                await asyncio.sleep(0.5)
+                
+                messages_data.append(message_info)
+                print(f"✅ Получено новое сообщение из группы {group_name}")
+                if message_info['media_path']:
+                    print(f"📎 Медиафайл сохранен: {message_info['media_path']}")
+            
+            print(f"📊 HTTP-кэш: {get_http_cache().report()}")
             
             if messages_data:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_file = os.path.join(vk_config['messages_folder'], f'messages_{timestamp}.json')
+                output_file = os.path.join(self.vk_config['messages_folder'], f'messages_{timestamp}.json')
                 
                 with open(output_file, 'w', encoding='utf-8') as f:
                     json.dump(messages_data, f, ensure_ascii=False, indent=4)
@@ -238,7 +292,10 @@ class VKParser:
             return False
 
 async def main():
+    global parser
     try:
+        vk_config = get_config()['sources'].get('vk', {})
+        
         if not vk_config.get('enabled', False):
             print("❌ Источник VK отключен в конфигурации")
             return False
@@ -247,9 +304,21 @@ async def main():
             print("❌ Не указан service_token в конфигурации")
             return False
 
-        print("\n🔄 Инициализация VK парсера...")
-        parser = VKParser(vk_config['service_token'])
-        print("✅ VK парсер инициализирован")
+        # Проверяем настройки VK API
+        if vk_config['service_token'] == "YOUR_VK_SERVICE_TOKEN":
+            print("❌ Ошибка: VK API токен не настроен. Отредактируйте config.json")
+            return False
+
+        create_folders(vk_config)
+        if (parser is None or parser.service_token != vk_config['service_token']
+                or parser.requests_per_second != vk_config.get('requests_per_second', 3)):
+            if parser is not None:
+                await parser.api.close()
+            print("\n🔄 Инициализация VK парсера...")
+            parser = VKParser(vk_config['service_token'], vk_config)
+            print("✅ VK парсер инициализирован")
+        else:
+            parser.vk_config = vk_config
         
         print("\n🔍 Начинаю проверку групп...")
         success = await parser.get_last_messages()
@@ -264,6 +333,18 @@ async def main():
         print(f"\n❌ Критическая ошибка в VK парсере: {str(e)}")
         return False
 
+async def close():
+    global parser
+    if parser is not None:
+        await parser.api.close()
+        parser = None
+
+async def run_once():
+    try:
+        return await main()
+    finally:
+        await close()
+
 if __name__ == '__main__':
-    success = asyncio.run(main())
+    success = asyncio.run(run_once())
     exit(0 if success else 1)
\ No newline at end of file